@@ -1,35 +1,47 @@
 """
 Основной файл Telegram бота для поиска авиабилетов.
 """
-import os
 import asyncio
 import logging
-from dotenv import load_dotenv
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.types import Message
-from aiogram.filters import CommandStart, Command
-from datetime import datetime
+from aiogram.filters import CommandStart
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+try:
+    import uvloop
+except ImportError:  # uvloop недоступен на Windows, используем стандартный event loop
+    uvloop = None
 
 from src.config import Config
-from src.services.openai_service import OpenAIService
-from src.services.aviasales_service import AviasalesService
-from src.utils.helpers import format_ticket_message
-from src.services.dialog_state import DialogStateManager
 
-# Загрузка переменных окружения
-load_dotenv()
+# Проверяем конфигурацию до создания клиентов внешних API
+Config.validate()
+
+from src.services.dialog_state import DialogState
+from src.services.registry import openai_service, aviasales_service, dialog_manager
+from src.utils.helpers import format_ticket_message
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Настройка логирования: обработчики только кладут записи в очередь,
+# а запись в поток вывода выполняется в отдельном потоке, не блокируя event loop
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(log_queue, log_handler)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener.start()
 logger = logging.getLogger(__name__)
 
-# Инициализация сервисов
-openai_service = OpenAIService()
-aviasales_service = AviasalesService()
-dialog_manager = DialogStateManager()
+# Сколько секунд ждать результатов поиска, прежде чем показать промежуточный статус
+SEARCH_STATUS_DELAY = 0.5
+
+# Ограничение одновременных обработчиков: всплеск сообщений не должен исчерпывать
+# пул соединений и лимиты запросов внешних API
+handler_semaphore = asyncio.Semaphore(Config.MAX_CONCURRENT_HANDLERS)
 
 # Инициализация бота и диспетчера
 bot = Bot(token=Config.TELEGRAM_TOKEN)
@@ -49,24 +61,39 @@ async def cmd_start(message: Message):
 
 @dp.message()
 async def handle_message(message: Message):
-    """Обработка входящих сообщений"""
+    """Обработка входящих сообщений с ограничением числа одновременных обработчиков"""
+    # Сначала ждем свою очередь среди сообщений пользователя, и только потом занимаем
+    # общий обработчик: серия сообщений одного пользователя не блокирует остальных
+    async with dialog_manager.with_state(message.from_user.id) as state:
+        wait_started = time.monotonic()
+        async with handler_semaphore:
+            wait_time = time.monotonic() - wait_started
+            if wait_time > 1:
+                logger.warning("Сообщение ждало свободного обработчика %.1f с", wait_time)
+            await process_message(message, state)
+
+async def process_message(message: Message, state: DialogState):
+    """Обработка сообщения с запросом на поиск билетов"""
     try:
         # Логируем входящее сообщение
-        logger.info(f"Получен запрос от {message.from_user.username}: {message.text}")
+        logger.info("Получен запрос от %s: %s", message.from_user.username, message.text)
         
-        # Получаем состояние диалога
-        state = dialog_manager.get_state(message.from_user.id)
-        
-        # Отправляем сообщение о начале поиска
-        status_message = await message.answer("🔍 Анализирую ваш запрос...")
-
-        # Извлекаем параметры полета с помощью OpenAI
+        # Отправляем сообщение о начале поиска и параллельно извлекаем параметры полета с помощью OpenAI
         current_state = {
             'origin': state.origin,
             'destination': state.destination,
             'departure_at': state.departure_at
         }
-        flight_params = await openai_service.extract_flight_params(message.text, current_state)
+        status_message, flight_params = await asyncio.gather(
+            message.answer("🔍 Анализирую ваш запрос..."),
+            openai_service.extract_flight_params(message.text, current_state),
+            return_exceptions=True
+        )
+        if isinstance(status_message, Exception):
+            raise status_message
+        if isinstance(flight_params, Exception):
+            logger.error("Ошибка при извлечении параметров полета: %s", flight_params, exc_info=flight_params)
+            flight_params = {}
         
         if not flight_params:
             await status_message.edit_text(
@@ -115,21 +142,36 @@ async def handle_message(message: Message):
             search_message += f"📅 Вылет: {state.departure_at}\n"
         
         if state.return_at:
-            search_message += f"🔄 Возвращение: {state.return_at}\n"
+            search_message += f"🔄 Возвращение: {state.return_at}"
+            if state.return_days:
+                search_message += f" ({state.return_days} дн.)"
+            search_message += "\n"
         else:
             search_message += "🔄 Билет в один конец\n"
         
-        await status_message.edit_text(search_message + "\n⏳ Идет поиск...")
-
         # Ищем билеты через Aviasales API
-        search_params = state.to_search_params()
-        search_params['date_context'] = date_context
+        search_params = {**state.to_search_params(), 'date_context': date_context}
         
         if is_flexible:
-            tickets = await aviasales_service.search_tickets_with_flexible_dates(search_params)
+            search_task = asyncio.create_task(aviasales_service.search_tickets_with_flexible_dates(search_params))
         else:
-            tickets = await aviasales_service.search_tickets(search_params)
-        
+            search_task = asyncio.create_task(aviasales_service.search_tickets(search_params))
+
+        # Промежуточный статус показываем, только если поиск идет дольше SEARCH_STATUS_DELAY:
+        # быстрый ответ (например, из кэша) сразу заменяет "Анализирую..." результатом
+        try:
+            done, _ = await asyncio.wait({search_task}, timeout=SEARCH_STATUS_DELAY)
+            if not done:
+                await status_message.edit_text(search_message + "\n⏳ Идет поиск...")
+            tickets = await search_task
+        finally:
+            # Ожидание прервано (ошибка промежуточного статуса, отмена обработчика):
+            # поиск отменяется, а уже завершившийся помечается как полученный
+            if not search_task.done():
+                search_task.cancel()
+            elif not search_task.cancelled():
+                search_task.exception()
+
         if not tickets.get('success') or not tickets.get('data'):
             await status_message.edit_text(
                 "😔 К сожалению, билетов по вашему запросу не найдено.\n"
@@ -163,23 +205,72 @@ async def handle_message(message: Message):
         dialog_manager.clear_state(message.from_user.id)
 
     except Exception as e:
-        logger.error(f"Ошибка при обработке сообщения: {e}", exc_info=True)
+        logger.error("Ошибка при обработке сообщения: %s", e, exc_info=True)
         await message.answer("😔 Произошла ошибка при обработке запроса. Попробуйте еще раз.")
         # Очищаем состояние диалога при ошибке
         dialog_manager.clear_state(message.from_user.id)
 
+@dp.startup()
+async def on_startup():
+    """Подготовка сервисов при запуске бота"""
+    await aviasales_service.warmup()
+
+@dp.shutdown()
+async def on_shutdown():
+    """Освобождение ресурсов при остановке бота"""
+    await asyncio.gather(aviasales_service.close(), openai_service.close())
+
+async def on_webhook_startup():
+    """Регистрация вебхука в Telegram"""
+    await bot.set_webhook(
+        f"{Config.WEBHOOK_URL}{Config.WEBHOOK_PATH}",
+        secret_token=Config.WEBHOOK_SECRET
+    )
+
+async def run_webhook():
+    """Прием обновлений через вебхук: Telegram сам присылает сообщения, без long polling"""
+    dp.startup.register(on_webhook_startup)
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=Config.WEBHOOK_SECRET
+    ).register(app, path=Config.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, Config.WEBAPP_HOST, Config.WEBAPP_PORT)
+    await site.start()
+    logger.info("Вебхук-сервер запущен на %s:%s", Config.WEBAPP_HOST, Config.WEBAPP_PORT)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     """Запуск бота"""
     try:
         logger.info("Запуск бота...")
-        await dp.start_polling(bot)
+        if Config.WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # Снимаем вебхук, если он был установлен ранее, иначе getUpdates не работает
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}")
+        logger.error("Ошибка при запуске бота: %s", e)
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
     except Exception as e:
-        logger.error(f"Бот остановлен из-за ошибки: {e}")
+        logger.error("Бот остановлен из-за ошибки: %s", e)
+    finally:
+        log_listener.stop()
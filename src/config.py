@@ -2,13 +2,49 @@
 Конфигурация и загрузка переменных окружения.
 """
 import os
+from typing import Final
 from dotenv import load_dotenv
 
 # Загрузка переменных окружения
 load_dotenv()
 
 class Config:
-    """Конфигурационные параметры"""
-    TELEGRAM_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-    OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-    AVIASALES_TOKEN = os.getenv('AVIASALES_API_KEY')
+    """Конфигурационные параметры (читаются из окружения один раз при импорте)"""
+    TELEGRAM_TOKEN: Final = os.getenv('TELEGRAM_BOT_TOKEN')
+    OPENAI_API_KEY: Final = os.getenv('OPENAI_API_KEY')
+    AVIASALES_TOKEN: Final = os.getenv('AVIASALES_API_KEY')
+    # Максимальное число одновременно обрабатываемых сообщений
+    MAX_CONCURRENT_HANDLERS: Final = int(os.getenv('MAX_CONCURRENT_HANDLERS', '50'))
+    # Максимальное число одновременных запросов к Aviasales API (ограничение по лимитам API)
+    AVIASALES_MAX_CONCURRENT_REQUESTS: Final = int(os.getenv('AVIASALES_MAX_CONCURRENT_REQUESTS', '10'))
+    # Максимальное число одновременных запросов к OpenAI API (ограничение по лимитам API)
+    OPENAI_MAX_CONCURRENT_REQUESTS: Final = int(os.getenv('OPENAI_MAX_CONCURRENT_REQUESTS', '20'))
+    # Модель OpenAI для ранжирования и, по умолчанию, для извлечения параметров
+    OPENAI_MODEL: Final = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+    # Модель для извлечения параметров полета (простая задача, достаточно небольшой модели)
+    EXTRACT_MODEL: Final = os.getenv('EXTRACT_MODEL') or OPENAI_MODEL
+    # Адрес OpenAI-совместимого сервера для извлечения (например, локальный vLLM); по умолчанию OpenAI
+    EXTRACT_BASE_URL: Final = os.getenv('EXTRACT_BASE_URL') or None
+    # Ранжирование билетов через OpenAI вместо локального (для отладки и сравнения)
+    USE_LLM_RANKING: Final = os.getenv('USE_LLM_RANKING', '').lower() in ('1', 'true', 'yes')
+
+    # Режим вебхука: включается, если задан публичный адрес (TLS терминируется на прокси)
+    WEBHOOK_URL: Final = os.getenv('WEBHOOK_URL')
+    WEBHOOK_PATH: Final = os.getenv('WEBHOOK_PATH', '/webhook')
+    WEBHOOK_SECRET: Final = os.getenv('WEBHOOK_SECRET')
+    WEBAPP_HOST: Final = os.getenv('WEBAPP_HOST', '0.0.0.0')
+    WEBAPP_PORT: Final = int(os.getenv('WEBAPP_PORT', '8080'))
+
+    # Обязательные параметры: атрибут -> переменная окружения
+    REQUIRED: Final = {
+        'TELEGRAM_TOKEN': 'TELEGRAM_BOT_TOKEN',
+        'OPENAI_API_KEY': 'OPENAI_API_KEY',
+        'AVIASALES_TOKEN': 'AVIASALES_API_KEY',
+    }
+
+    @classmethod
+    def validate(cls) -> None:
+        """Проверяет наличие обязательных параметров до начала обработки запросов"""
+        missing = [env for attr, env in cls.REQUIRED.items() if not getattr(cls, attr)]
+        if missing:
+            raise RuntimeError(f"Не заданы переменные окружения: {', '.join(missing)}")
@@ -1,37 +1,164 @@
 """
 Сервис для работы с Aviasales API.
 """
+import functools
+import heapq
+import itertools
 import logging
-import json
-from datetime import datetime, timedelta
+import re
+from operator import itemgetter
+from datetime import date
+from types import MappingProxyType
+from typing import Final
 import aiohttp
 import asyncio
+import orjson
 from ..config import Config
+from ..utils.cache import TTLCache
+from ..utils.cities import CITIES
+from ..utils.retry import RetryableError, retry_async
 
 logger = logging.getLogger(__name__)
 
+# Название города -> IATA код (из общего справочника городов)
+AIRPORT_CODES: Final = MappingProxyType({name: code for name, (code, _) in CITIES.items()})
+
+# Ключ выбора по цене: билеты без цены отбрасываются в _process_response
+_get_price = itemgetter('price')
+
+# Веса критериев оценки билета: цена (самый важный фактор), длительность, пересадки
+WEIGHTS: Final = (5.0, 4.0, 2.0)
+# Нормализация: цена относительно 10000 руб., длительность относительно 4 часов
+PRICE_NORM: Final = 10000.0
+DURATION_NORM: Final = 240.0
+
+# Формат IATA кода: три заглавные латинские буквы
+_IATA_MATCH = re.compile(r'\A[A-Z]{3}\Z').match
+
+# Формат даты YYYY-MM-DD: date.fromisoformat в Python 3.11 принимает и другие формы ISO 8601
+_ISO_DATE_MATCH = re.compile(r'\A[0-9]{4}-[0-9]{2}-[0-9]{2}\Z').match
+
+def _is_iata(code) -> bool:
+    """Проверка формата IATA кода"""
+    return isinstance(code, str) and _IATA_MATCH(code) is not None
+
+def _score_kernel(
+    prices: list[float],
+    durations: list[float],
+    transfers: list[int],
+    duration_bonus: float = 0.0
+) -> list[float]:
+    """Оценки билетов по столбцам числовых полей.
+
+    Чем дешевле, быстрее и с меньшим числом пересадок билет, тем выше оценка.
+    Нулевая цена или длительность (нет данных) не дает вклада в оценку.
+    duration_bonus добавляется к весу длительности (для близких по цене билетов).
+    """
+    price_weight, duration_weight, transfers_weight = WEIGHTS
+    price_factor = price_weight * PRICE_NORM
+    duration_factor = (duration_weight + duration_bonus) * DURATION_NORM
+
+    scores = []
+    append = scores.append
+    for price, duration, transfer_count in zip(prices, durations, transfers):
+        # +1 чтобы избежать деления на ноль
+        score = transfers_weight / (transfer_count + 1)
+        if price > 0:
+            score += price_factor / price
+        if duration > 0:
+            score += duration_factor / duration
+        append(score)
+    return scores
+
+class _SearchAbandoned(Exception):
+    """Запрос к API, результата которого ждут другие, отменен начавшим его"""
+
 class AviasalesService:
     """Сервис для работы с Aviasales API"""
-    AIRPORT_CODES = {
-        'Москва': 'MOW',
-        'Санкт-Петербург': 'LED',
-        'Париж': 'PAR',
-        'Барселона': 'BCN',
-        'Рим': 'ROM'
-    }
+    AIRPORT_CODES = AIRPORT_CODES
+    CACHE_MAXSIZE = 2048
+    CACHE_TTL = 600  # секунд, цены по направлению стабильны в течение десятков минут
+    # Одновременных запросов к API не больше, чем соединений на хост в пуле:
+    # веерный поиск по датам не ждет освобождения соединения
+    MAX_CONCURRENT_REQUESTS = Config.AVIASALES_MAX_CONCURRENT_REQUESTS
+    CONNECTIONS_PER_HOST = max(20, MAX_CONCURRENT_REQUESTS)
+    # С какого числа билетов ранжирование занимает ~5 мс и выносится в отдельный поток
+    RANK_IN_THREAD_MIN_TICKETS = 1500
+    # Сколько секунд ждать все даты гибкого поиска, если часть билетов уже найдена
+    FLEXIBLE_SEARCH_SOFT_TIMEOUT = 5.0
+    # Общий срок запроса на одну дату вместе с повторами и паузами между ними
+    DATE_SEARCH_DEADLINE = 20.0
 
     def __init__(self):
         self.api_token = Config.AVIASALES_TOKEN
         self.base_url = "https://api.travelpayouts.com/aviasales/v3"  # Убрал /prices_for_dates из базового URL
+        self._cache = TTLCache(maxsize=self.CACHE_MAXSIZE, ttl=self.CACHE_TTL)
+        # Итоговые результаты поиска по диапазону дат: без повторного объединения и ранжирования
+        self._results_cache = TTLCache(maxsize=self.CACHE_MAXSIZE, ttl=self.CACHE_TTL)
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self._session: aiohttp.ClientSession | None = None
+        self._session_lock = asyncio.Lock()
+        self._api_semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Общая HTTP-сессия: соединения и DNS-кэш переиспользуются между запросами"""
+        if self._session is not None and not self._session.closed:
+            return self._session
+
+        # Одновременные первые запросы не должны создать несколько сессий
+        async with self._session_lock:
+            if self._session is None or self._session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=100,
+                    limit_per_host=self.CONNECTIONS_PER_HOST,
+                    keepalive_timeout=30,
+                    ttl_dns_cache=300,
+                    enable_cleanup_closed=True
+                )
+                self._session = aiohttp.ClientSession(
+                    connector=connector,
+                    timeout=aiohttp.ClientTimeout(total=30, connect=10),
+                    # Токен и заголовки одинаковы для всех запросов, поэтому задаются на уровне сессии;
+                    # ответ API приходит в сжатом виде, что в разы уменьшает объем передаваемых данных
+                    headers={
+                        'X-Access-Token': self.api_token,
+                        'Accept': 'application/json',
+                        'Accept-Encoding': 'gzip'
+                    }
+                )
+        return self._session
 
-    def _get_airport_code(self, city: str) -> str:
-        """Получение IATA кода аэропорта"""
-        return self.AIRPORT_CODES.get(city, city)
+    async def warmup(self) -> None:
+        """Прогрев соединения с API: DNS и TLS-сессия готовы до первого запроса пользователя"""
+        try:
+            session = await self._get_session()
+            async with session.head(
+                self.base_url,
+                allow_redirects=False,
+                timeout=aiohttp.ClientTimeout(total=2)
+            ):
+                pass
+        except Exception as e:
+            logger.warning("Не удалось прогреть соединение с Aviasales API: %s", e)
+
+    async def close(self) -> None:
+        """Закрытие HTTP-сессии при остановке бота"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _parse_date(date_str: str) -> date:
+        """Разбор даты в формате YYYY-MM-DD, ValueError при некорректном значении"""
+        if not _ISO_DATE_MATCH(date_str):
+            raise ValueError(f"Ожидается дата в формате YYYY-MM-DD: {date_str!r}")
+        return date.fromisoformat(date_str)
 
     def _validate_params(self, params: dict) -> bool:
         """Проверяет корректность параметров поиска"""
         if not isinstance(params, dict):
-            logger.error(f"Параметры должны быть словарем, получено: {type(params)}")
+            logger.error("Параметры должны быть словарем, получено: %s", type(params))
             return False
 
         required_fields = ['origin', 'departure_at']
@@ -39,118 +166,80 @@ class AviasalesService:
         # Проверка наличия обязательных полей
         missing_fields = [field for field in required_fields if not params.get(field)]
         if missing_fields:
-            logger.error(f"Отсутствуют обязательные параметры: {', '.join(missing_fields)}")
-            logger.debug(f"Текущие параметры: {json.dumps(params, ensure_ascii=False)}")
+            logger.error("Отсутствуют обязательные параметры: %s", ', '.join(missing_fields))
+            logger.debug("Текущие параметры: %s", params)
             return False
         
         # Проверка формата IATA кодов
         for field in ['origin', 'destination']:
             iata_code = params.get(field)
-            if iata_code and not (len(iata_code) == 3 and iata_code.isupper() and iata_code.isalpha()):
-                logger.error(f"Некорректный формат IATA кода {field}: {iata_code}")
+            if iata_code and not _is_iata(iata_code):
+                logger.error("Некорректный формат IATA кода %s: %s", field, iata_code)
                 return False
         
         # Проверка формата дат
         try:
-            departure_date = datetime.strptime(params['departure_at'], '%Y-%m-%d')
+            departure_date = self._parse_date(params['departure_at'])
             if params.get('return_at'):
-                return_date = datetime.strptime(params['return_at'], '%Y-%m-%d')
+                return_date = self._parse_date(params['return_at'])
                 if return_date <= departure_date:
-                    logger.error(f"Дата возврата {params['return_at']} должна быть после даты вылета {params['departure_at']}")
+                    logger.error("Дата возврата %s должна быть после даты вылета %s", params['return_at'], params['departure_at'])
                     return False
-        except ValueError as e:
-            logger.error(f"Некорректный формат даты: {str(e)}")
+        except (TypeError, ValueError) as e:
+            logger.error("Некорректный формат даты: %s", e)
             return False
         
-        logger.info(f"Параметры поиска прошли валидацию: {json.dumps(params, ensure_ascii=False)}")
+        logger.debug("Параметры поиска прошли валидацию: %s", params)
         return True
 
-    def _format_date(self, date_str: str) -> str:
-        """Форматирование даты для API"""
-        try:
-            date = datetime.strptime(date_str, '%Y-%m-%d')
-            return date.strftime('%Y-%m-%d')
-        except Exception as e:
-            logger.error(f"Ошибка форматирования даты: {e}")
-            return None
+    @staticmethod
+    def _score_tickets(tickets: list, duration_bonus: float = 0.0) -> list[float]:
+        """Оценки для списка билетов: числовые поля извлекаются за один проход и передаются в _score_kernel"""
+        prices, durations, transfers = [], [], []
+        for ticket in tickets:
+            get = ticket.get
+            prices.append(float(get('price') or 0))
+            durations.append(float(get('duration') or 0))
+            transfers.append(int(get('transfers') or 0))
+        return _score_kernel(prices, durations, transfers, duration_bonus)
 
-    def _calculate_ticket_score(self, ticket: dict) -> float:
-        """Вычисление оценки для билета на основе критериев"""
-        try:
-            # Веса для разных критериев
-            WEIGHTS = {
-                'price': 5.0,      # Цена (самый важный фактор)
-                'duration': 4.0,   # Длительность полета
-                'transfers': 2.0,  # Количество пересадок
-            }
-            
-            scores = {}
-            
-            # Оценка цены (обратная зависимость - чем дешевле, тем лучше)
-            base_price = float(ticket['price'])
-            scores['price'] = 1.0 / (base_price / 10000)  # Нормализация относительно 10000
-            
-            # Оценка длительности (обратная зависимость)
-            duration = float(ticket.get('duration', 0))
-            scores['duration'] = 1.0 / (duration / 240)  # Нормализация относительно 4 часов
-            
-            # Оценка количества пересадок (обратная зависимость)
-            transfers = int(ticket.get('transfers', 0))
-            scores['transfers'] = 1.0 / (transfers + 1)  # +1 чтобы избежать деления на ноль
-            
-            # Базовая оценка
-            total_score = sum(scores[key] * WEIGHTS[key] for key in WEIGHTS)
-            
-            return total_score
-            
-        except Exception as e:
-            logger.error(f"Ошибка при расчете оценки билета: {e}", exc_info=True)
-            return 0.0
+    def _rank_tickets(self, tickets: list, limit: int = 10) -> list:
+        """Ранжирование билетов по различным критериям: лучшие limit вариантов.
 
-    def _rank_tickets(self, tickets: list) -> list:
-        """Ранжирование билетов по различным критериям"""
+        Билеты в пределах 10% от минимальной цены упорядочиваются по оценке
+        с повышенным весом длительности, остальные следуют за ними по возрастанию цены.
+        """
         try:
             if not tickets:
                 return []
 
-            # Сначала сортируем по цене для определения минимальной цены
-            tickets.sort(key=lambda x: x.get('price', float('inf')))
-            min_price = tickets[0]['price']
+            min_price = min(tickets, key=_get_price)['price']
 
-            # Группируем билеты по ценовым диапазонам (в пределах 10% разницы)
-            price_groups = []
-            current_group = []
-            
+            # Отделяем группу билетов в пределах 10% от минимальной цены
+            best_group = []
+            other_tickets = []
             for ticket in tickets:
                 price_diff_percent = ((ticket['price'] - min_price) / min_price) * 100
-                if not current_group or price_diff_percent <= 10:
-                    current_group.append(ticket)
-                else:
-                    if current_group:
-                        price_groups.append(current_group)
-                    current_group = [ticket]
-            
-            if current_group:
-                price_groups.append(current_group)
+                (best_group if price_diff_percent <= 10 else other_tickets).append(ticket)
 
-            # Сортируем каждую группу с приоритетом длительности
-            sorted_groups = []
-            for group in price_groups:
-                # Для билетов в пределах 10% разницы в цене увеличиваем вес длительности
-                for ticket in group:
-                    ticket['_score'] = self._calculate_ticket_score(ticket)
-                    if len(group) > 1:  # Если в группе больше одного билета
-                        # Увеличиваем влияние длительности для близких по цене билетов
-                        duration_score = 1.0 / (float(ticket.get('duration', 0)) / 240)
-                        ticket['_score'] += duration_score * 2  # Дополнительный бонус за длительность
+            # Для билетов в пределах 10% разницы в цене увеличиваем вес длительности
+            # (если в группе больше одного билета): бонус входит в ту же формулу оценки
+            duration_bonus = 2.0 if len(best_group) > 1 else 0.0
+            for ticket, score in zip(best_group, self._score_tickets(best_group, duration_bonus)):
+                ticket['_score'] = score
 
-                group.sort(key=lambda x: x['_score'], reverse=True)
-                sorted_groups.extend(group)
+            # Отбираем лучшие варианты без полной сортировки всех билетов
+            ranked_tickets = heapq.nlargest(limit, best_group, key=itemgetter('_score'))
+            if len(ranked_tickets) < limit:
+                cheapest_others = heapq.nsmallest(limit - len(ranked_tickets), other_tickets, key=_get_price)
+                for ticket, score in zip(cheapest_others, self._score_tickets(cheapest_others)):
+                    ticket['_score'] = score
+                ranked_tickets.extend(cheapest_others)
 
-            return sorted_groups
+            return ranked_tickets
 
         except Exception as e:
-            logger.error(f"Ошибка при ранжировании билетов: {e}", exc_info=True)
+            logger.error("Ошибка при ранжировании билетов: %s", e, exc_info=True)
             return tickets
 
     def rank_tickets(self, tickets: list) -> dict:
@@ -162,12 +251,12 @@ class AviasalesService:
                     "summary": "Нет билетов для ранжирования"
                 }
 
-            # Вычисляем оценки для каждого билета
-            scored_tickets = [(ticket, self._calculate_ticket_score(ticket)) for ticket in tickets]
+            # Вычисляем оценки для всех билетов за один проход
+            scores = self._score_tickets(tickets)
             
-            # Сортируем билеты по оценке (по убыванию) и берем топ-10
-            scored_tickets.sort(key=lambda x: x[1], reverse=True)
-            top_tickets = [ticket for ticket, _ in scored_tickets[:10]]
+            # Берем индексы топ-10 по оценке без полной сортировки и без пар (билет, оценка)
+            top_indices = heapq.nlargest(10, range(len(tickets)), key=scores.__getitem__)
+            top_tickets = [tickets[i] for i in top_indices]
             
             # Создаем краткое описание ранжирования
             best_ticket = top_tickets[0]
@@ -183,7 +272,7 @@ class AviasalesService:
             }
             
         except Exception as e:
-            logger.error(f"Ошибка ранжирования билетов: {e}", exc_info=True)
+            logger.error("Ошибка ранжирования билетов: %s", e, exc_info=True)
             return {
                 "ranked_tickets": tickets[:10] if tickets else [],
                 "summary": "Ошибка при ранжировании билетов"
@@ -191,22 +280,25 @@ class AviasalesService:
 
     async def search_tickets(self, params: dict) -> dict:
         """Поиск билетов через API Aviasales"""
-        try:
-            if not self._validate_params(params):
-                return {"success": False, "error": "Invalid parameters"}
+        if not self._validate_params(params):
+            return {"success": False, "error": "Invalid parameters"}
+        return await self._search_validated(params)
 
+    async def _search_validated(self, params: dict) -> dict:
+        """Поиск билетов по уже проверенным параметрам"""
+        try:
             # Всегда используем поиск с гибкими датами
             if params.get('flexible_dates', True):
                 logger.info("Используем поиск с гибкими датами")
-                return await self.search_tickets_with_flexible_dates(params)
+                return await self._search_flexible_dates(params)
             
-            logger.info("Начало поиска билетов. Параметры: " + json.dumps(params, ensure_ascii=False))
+            logger.debug("Начало поиска билетов. Параметры: %s", params)
             
-            async with aiohttp.ClientSession() as session:
-                return await self._search_tickets_for_date(session, params)
+            session = await self._get_session()
+            return await self._search_tickets_for_date(session, params)
                 
         except Exception as e:
-            logger.error(f"Ошибка при поиске билетов: {e}", exc_info=True)
+            logger.error("Ошибка при поиске билетов: %s", e, exc_info=True)
             return {'success': False, 'error': str(e)}
 
     async def search_tickets_in_range(self, params: dict) -> dict:
@@ -218,100 +310,282 @@ class AviasalesService:
 
             # Если указано начало месяца, ищем билеты на первые 5 дней
             if params.get('date_context', {}).get('is_start_of_month'):
-                base_date = datetime.strptime(params['departure_at'], '%Y-%m-%d')
+                cache_key = self._results_cache_key('range', params)
+                if (cached := self._results_cache.get(cache_key)) is not None:
+                    return self._copy_result(cached)
+
+                base_day = self._parse_date(params['departure_at']).toordinal()
                 return_days = params.get('date_context', {}).get('return_days')
                 
-                all_tickets = []
-                async with aiohttp.ClientSession() as session:
-                    tasks = []
-                    for day_offset in range(5):  # Ищем на первые 5 дней месяца
-                        search_date = base_date + timedelta(days=day_offset)
-                        search_params = params.copy()
-                        search_params['departure_at'] = search_date.strftime('%Y-%m-%d')
+                session = await self._get_session()
+                base_params = self._base_search_params(params)
+                tasks = []
+                for search_day in range(base_day, base_day + 5):  # Ищем на первые 5 дней месяца
+                    search_params = {**base_params, 'departure_at': date.fromordinal(search_day).isoformat()}
                         
-                        if return_days is not None:
-                            return_date = search_date + timedelta(days=return_days)
-                            search_params['return_at'] = return_date.strftime('%Y-%m-%d')
+                    if return_days is not None:
+                        search_params['return_at'] = date.fromordinal(search_day + return_days).isoformat()
                         
-                        tasks.append(self._search_tickets_for_date(session, search_params))
-                    
-                    results = await asyncio.gather(*tasks)
-                    for result in results:
-                        if result and result.get('success') and result.get('data'):
-                            all_tickets.extend(result['data'])
-                
-                if not all_tickets:
+                    tasks.append(asyncio.create_task(self._search_tickets_for_date(session, search_params)))
+
+                # Возвращаем топ-10 самых дешевых билетов, отбирая их по мере завершения запросов
+                cheapest_tickets = await self._collect_cheapest(tasks, limit=10)
+
+                if not cheapest_tickets:
                     return {'success': False, 'error': 'Билеты не найдены'}
                 
-                # Сортируем билеты по цене
-                all_tickets.sort(key=lambda x: x.get('price', float('inf')))
-                
-                return {
+                result = {
                     'success': True,
-                    'data': all_tickets[:10],  # Возвращаем топ-10 самых дешевых билетов
+                    'data': cheapest_tickets,
                     'currency': 'RUB'
                 }
+                self._results_cache.set(cache_key, self._copy_result(result))
+                return result
             
             # Если нет указания на начало месяца, делаем обычный поиск
-            return await self.search_tickets(params)
+            return await self._search_validated(params)
                     
         except Exception as e:
-            logger.error(f"Ошибка при поиске билетов в диапазоне: {e}", exc_info=True)
+            logger.error("Ошибка при поиске билетов в диапазоне: %s", e, exc_info=True)
             return {'success': False, 'error': str(e)}
 
     async def _search_tickets_for_date(self, session: aiohttp.ClientSession, params: dict) -> dict:
         """Поиск билетов на конкретную дату"""
         try:
-            url = f"{self.base_url}/prices_for_dates"
-            
-            query_params = {
-                'origin': params['origin'],
-                'destination': params.get('destination'),
-                'departure_at': params['departure_at'],
-                'return_at': params.get('return_at'),
-                'unique': 'false',
-                'sorting': 'price',
-                'direct': 'false',
-                'currency': 'rub',
-                'limit': '30',
-                'page': '1',
-                'one_way': 'true' if not params.get('return_at') else 'false'
-            }
+            # Параметры запроса собираются списком пар без пустых значений:
+            # aiohttp не принимает None в query string
+            return_at = params.get('return_at')
+            query_params = [
+                ('origin', params['origin']),
+                ('departure_at', params['departure_at']),
+                ('unique', 'false'),
+                ('sorting', 'price'),
+                ('direct', 'false'),
+                ('currency', 'rub'),
+                ('limit', '30'),
+                ('page', '1'),
+                ('one_way', 'false' if return_at else 'true')
+            ]
+            if destination := params.get('destination'):
+                query_params.append(('destination', destination))
+            if return_at:
+                query_params.append(('return_at', return_at))
+
+            cache_key = tuple(query_params)
+            if (cached := self._cache.get(cache_key)) is not None:
+                logger.debug("Билеты взяты из кэша: %s", cache_key)
+                return self._copy_result(cached)
+
+            # Одинаковые запросы от разных пользователей ждут результат одного вызова API (single-flight)
+            while (inflight := self._inflight.get(cache_key)) is not None:
+                try:
+                    result = await asyncio.shield(inflight)
+                except _SearchAbandoned:
+                    # Начавший запрос отменен: ожидающий выполняет запрос сам
+                    continue
+                return self._copy_result(result) if result.get('success') else result
+
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[cache_key] = future
+            try:
+                async with asyncio.timeout(self.DATE_SEARCH_DEADLINE):
+                    result = await retry_async(self._fetch_prices_limited, session, query_params, params)
+                if result.get('success'):
+                    self._cache.set(cache_key, result)
+                future.set_result(result)
+                return self._copy_result(result) if result.get('success') else result
+            except BaseException as e:
+                # Отмена начавшего запрос не должна отменять ожидающих: они получают обычную ошибку
+                # и повторяют запрос сами
+                future.set_exception(e if isinstance(e, Exception) else _SearchAbandoned())
+                future.exception()  # ожидающих может не быть, помечаем исключение как полученное
+                raise
+            finally:
+                self._inflight.pop(cache_key, None)
 
-            logger.info(f"Отправка запроса к Aviasales API: {url}")
-            logger.debug(f"Параметры запроса: {json.dumps(query_params, ensure_ascii=False)}")
-            
-            async with session.get(
-                url,
-                params=query_params,
-                headers={'X-Access-Token': self.api_token}
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logger.error(f"Ошибка API Aviasales ({response.status}): {error_text}")
-                    return {'success': False, 'error': f'API error: {response.status}'}
-                
-                data = await response.json()
-                logger.info(f"Получено {len(data.get('data', []))} билетов от API")
-                
-                if not data.get('success'):
-                    logger.error(f"Ошибка в ответе API: {data.get('error')}")
-                    return {'success': False, 'error': data.get('error')}
-                
-                return self._process_response(data, params)
-                
         except Exception as e:
-            logger.error(f"Ошибка при поиске билетов на дату: {e}", exc_info=True)
+            logger.error("Ошибка при поиске билетов на дату: %s", e, exc_info=True)
             return {'success': False, 'error': str(e)}
 
+    async def _fetch_prices_limited(self, session: aiohttp.ClientSession, query_params: list, params: dict) -> dict:
+        """Одна попытка запроса под семафором: пауза перед повтором не занимает слот"""
+        # Ограничиваем число одновременных запросов, чтобы не упираться в лимиты API
+        async with self._api_semaphore:
+            return await self._fetch_prices_for_dates(session, query_params, params)
+
+    async def _fetch_prices_for_dates(self, session: aiohttp.ClientSession, query_params: list, params: dict) -> dict:
+        """Запрос к методу prices_for_dates API Aviasales"""
+        url = f"{self.base_url}/prices_for_dates"
+
+        logger.info("Отправка запроса к Aviasales API: %s", url)
+        logger.debug("Параметры запроса: %s", query_params)
+        
+        async with session.get(url, params=query_params) as response:
+            if response.status == 429 or response.status >= 500:
+                raise RetryableError(
+                    f"API error: {response.status}",
+                    retry_after=self._parse_retry_after(response.headers.get('Retry-After'))
+                )
+            # Тело читается один раз в байтах: без отдельного декодирования в строку
+            raw = await response.read()
+            logger.debug("Ответ API Aviasales: статус %d, %d байт", response.status, len(raw))
+            if response.status != 200:
+                logger.error("Ошибка API Aviasales (%d): %s", response.status, raw[:512].decode('utf-8', 'replace'))
+                return {'success': False, 'error': f'API error: {response.status}'}
+            
+            data = orjson.loads(raw)
+            
+            if not data.get('success'):
+                logger.error("Ошибка в ответе API: %s", data.get('error'))
+                return {'success': False, 'error': data.get('error')}
+            
+            return self._process_response(data, params)
+
+    @staticmethod
+    def _parse_retry_after(value: str | None) -> float | None:
+        """Значение заголовка Retry-After в секундах"""
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _merge_results(results: list) -> list:
+        """Объединение билетов из результатов параллельных запросов без дубликатов"""
+        unique_tickets = {}
+        ticket_key = AviasalesService._ticket_key
+        for result in results:
+            if isinstance(result, dict) and result.get('success') and result.get('data'):
+                for ticket in result['data']:
+                    unique_tickets.setdefault(ticket_key(ticket), ticket)
+        return list(unique_tickets.values())
+
+    @staticmethod
+    def _ticket_key(ticket: dict) -> tuple:
+        """Ключ билета для удаления дубликатов из ответов на соседние даты.
+
+        Один и тот же рейс с одинаковой ценой приходит с разными ссылками
+        (в ссылке есть параметры поиска), поэтому сравниваются рейс, даты и цена.
+        Без номера рейса билет определяется ссылкой.
+        """
+        if ticket.get('flight_number') is None:
+            return (ticket.get('price'), ticket.get('link'))
+        return (
+            ticket.get('airline'),
+            ticket.get('flight_number'),
+            ticket.get('departure_at'),
+            ticket.get('return_at'),
+            ticket.get('price')
+        )
+
+    @staticmethod
+    async def _collect_cheapest(tasks: list, limit: int) -> list:
+        """Самые дешевые уникальные билеты из результатов запросов по мере их завершения.
+
+        Билеты отбираются в ограниченную кучу сразу после ответа на каждую дату,
+        а не после ожидания всех запросов. Незавершенные запросы отменяются,
+        если сбор прерван.
+        """
+        heap = []  # (-цена, -порядковый номер, билет): на вершине самый дорогой из отобранных
+        seen = set()
+        counter = itertools.count()
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                try:
+                    result = await next_result
+                except Exception as e:
+                    logger.warning("Запрос билетов на дату не выполнен: %s", e)
+                    continue
+                if not (isinstance(result, dict) and result.get('success')):
+                    continue
+
+                for ticket in result.get('data') or []:
+                    price = ticket.get('price')
+                    key = AviasalesService._ticket_key(ticket)
+                    if price is None or key in seen:
+                        continue
+                    seen.add(key)
+                    item = (-price, -next(counter), ticket)
+                    if len(heap) < limit:
+                        heapq.heappush(heap, item)
+                    elif item[0] > heap[0][0]:
+                        heapq.heapreplace(heap, item)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+        return [ticket for _, _, ticket in sorted(heap, key=itemgetter(0, 1), reverse=True)]
+
+    async def _gather_with_soft_timeout(self, coros: list) -> tuple[list, int]:
+        """Результаты запросов, завершившихся до мягкого таймаута, и число недождавшихся.
+
+        Если к таймауту уже найдены билеты, отстающие запросы отменяются: они не
+        занимают слоты семафора и соединения после ответа пользователю. Если билетов
+        еще нет, ждем все запросы.
+        """
+        tasks = [asyncio.create_task(coro) for coro in coros]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=self.FLEXIBLE_SEARCH_SOFT_TIMEOUT)
+            if pending and not any(self._has_tickets(task) for task in done):
+                await asyncio.wait(pending)
+                done, pending = set(tasks), set()
+            elif pending:
+                for task in pending:
+                    task.cancel()
+                # Дожидаемся завершения отмены, чтобы запросы освободили ресурсы до возврата результата
+                await asyncio.wait(pending)
+        except asyncio.CancelledError:
+            # Отменен вызывающий: запросы по датам не должны продолжаться без него
+            for task in tasks:
+                task.cancel()
+            raise
+
+        results = [
+            task.exception() or task.result()
+            for task in tasks if task in done
+        ]
+        return results, len(pending)
+
+    @staticmethod
+    def _has_tickets(task: asyncio.Task) -> bool:
+        """Завершенный запрос вернул хотя бы один билет"""
+        if task.exception() is not None:
+            return False
+        result = task.result()
+        return isinstance(result, dict) and bool(result.get('success') and result.get('data'))
+
+    @staticmethod
+    def _base_search_params(params: dict) -> dict:
+        """Параметры, общие для всех дат веерного поиска: только то, что нужно запросу к API"""
+        return {key: params[key] for key in ('origin', 'destination', 'return_at') if params.get(key)}
+
+    @staticmethod
+    def _results_cache_key(kind: str, params: dict) -> tuple:
+        """Ключ кэша итоговых результатов поиска"""
+        return (
+            kind,
+            params.get('origin'),
+            params.get('destination'),
+            params.get('departure_at'),
+            params.get('return_at'),
+            orjson.dumps(params.get('date_context') or {}, option=orjson.OPT_SORT_KEYS)
+        )
+
+    @staticmethod
+    def _copy_result(result: dict) -> dict:
+        """Копия результата из кэша: билеты дополняются при ранжировании, кэш менять нельзя"""
+        return {**result, 'data': [dict(ticket) for ticket in result.get('data', [])]}
+
     def _process_response(self, data: dict, params: dict) -> dict:
         """Обработка ответа от API"""
         try:
-            tickets = data.get('data', [])
-            logger.info(f"Получено {len(tickets)} билетов от API")
+            # Билеты без цены бесполезны для пользователя и ломают сортировку по цене
+            tickets = [ticket for ticket in data.get('data') or [] if ticket.get('price') is not None]
+            logger.info("Получено %d билетов от API", len(tickets))
             
-            # Сортируем билеты по цене
-            tickets.sort(key=lambda x: x.get('price', float('inf')))
+            # Не сортируем: запрос идет с sorting=price, и API уже возвращает билеты по возрастанию цены,
+            # а объединенные результаты дат все равно заново ранжируются
             
             return {
                 'success': True,
@@ -320,7 +594,7 @@ class AviasalesService:
             }
         
         except Exception as e:
-            logger.error(f"Ошибка обработки ответа от API: {e}", exc_info=True)
+            logger.error("Ошибка обработки ответа от API: %s", e, exc_info=True)
             return {
                 'success': False,
                 'data': [],
@@ -329,94 +603,108 @@ class AviasalesService:
 
     async def search_tickets_with_flexible_dates(self, params: dict) -> dict:
         """Поиск билетов с гибкими датами"""
+        if not self._validate_params(params):
+            return {"success": False, "error": "Invalid parameters"}
+        return await self._search_flexible_dates(params)
+
+    async def _search_flexible_dates(self, params: dict) -> dict:
+        """Поиск билетов с гибкими датами по уже проверенным параметрам"""
         try:
-            if not self._validate_params(params):
-                return {"success": False, "error": "Invalid parameters"}
+            cache_key = self._results_cache_key('flexible', params)
+            if (cached := self._results_cache.get(cache_key)) is not None:
+                logger.info("Результаты поиска с гибкими датами взяты из кэша")
+                return self._copy_result(cached)
 
             date_context = params.get('date_context', {})
-            base_date = datetime.strptime(params['departure_at'], '%Y-%m-%d')
-            logger.info(f"Начинаем поиск с гибкими датами. Базовая дата: {base_date.strftime('%Y-%m-%d')}")
+            base_date = self._parse_date(params['departure_at'])
+            logger.info("Начинаем поиск с гибкими датами. Базовая дата: %s", params['departure_at'])
             
-            search_dates = []
+            # Даты поиска считаются в порядковых номерах дней: без datetime-арифметики в цикле
+            base_day = base_date.toordinal()
             if date_context.get('is_start_of_month'):
                 # Ищем билеты на первые 5 дней месяца
-                logger.info("Поиск на первые 5 дней месяца")
-                for day in range(5):
-                    search_date = base_date + timedelta(days=day)
-                    search_dates.append(search_date)
-                    logger.info(f"Добавлена дата поиска: {search_date.strftime('%Y-%m-%d')}")
+                logger.debug("Поиск на первые 5 дней месяца")
+                search_days = [base_day + day for day in range(5)]
             else:
                 # Ищем билеты в диапазоне ±2 дня от указанной даты
-                logger.info("Поиск в диапазоне ±2 дня")
-                for day in range(-2, 3):
-                    search_date = base_date + timedelta(days=day)
-                    search_dates.append(search_date)
-                    logger.info(f"Добавлена дата поиска: {search_date.strftime('%Y-%m-%d')}")
+                logger.debug("Поиск в диапазоне ±2 дня")
+                search_days = [base_day + day for day in range(-2, 3)]
 
-            all_tickets = []
-            
-            # Выполняем все запросы параллельно с помощью aiohttp.ClientSession
-            async with aiohttp.ClientSession() as session:
-                tasks = []
-                
-                # Создаем параметры поиска для каждой даты
-                for search_date in search_dates:
-                    search_params = params.copy()
-                    search_params['departure_at'] = search_date.strftime('%Y-%m-%d')
-                    
-                    if date_context.get('duration_days'):
-                        # Если указан диапазон длительности
-                        duration_days = date_context['duration_days']
-                        if isinstance(duration_days, list):
-                            min_days, max_days = duration_days
-                            logger.info(f"Поиск с диапазоном длительности {min_days}-{max_days} дней")
-                            # Проверяем несколько вариантов длительности с шагом в 2-3 дня
-                            step = max(2, (max_days - min_days) // 3)  # Адаптивный шаг
-                            logger.info(f"Используем шаг {step} дней для поиска")
-                            for duration in range(min_days, max_days + 1, step):
-                                search_params_with_duration = search_params.copy()
-                                return_date = search_date + timedelta(days=duration)
-                                search_params_with_duration['return_at'] = return_date.strftime('%Y-%m-%d')
-                                logger.info(f"Поиск билетов: вылет {search_params_with_duration['departure_at']}, возврат {search_params_with_duration['return_at']} (длительность {duration} дней)")
-                                tasks.append(self._search_tickets_for_date(session, search_params_with_duration))
-                        else:
-                            # Если указана конкретная длительность
-                            return_date = search_date + timedelta(days=duration_days)
-                            search_params['return_at'] = return_date.strftime('%Y-%m-%d')
-                            logger.info(f"Поиск билетов: вылет {search_params['departure_at']}, возврат {search_params['return_at']} (длительность {duration_days} дней)")
-                            tasks.append(self._search_tickets_for_date(session, search_params))
-                    else:
-                        # Поиск билетов только в одну сторону
-                        logger.info(f"Поиск билетов только в одну сторону на дату {search_params['departure_at']}")
-                        tasks.append(self._search_tickets_for_date(session, search_params))
-
-                logger.info(f"Всего создано {len(tasks)} поисковых запросов")
-                
-                # Выполняем все запросы параллельно
-                results = await asyncio.gather(*tasks, return_exceptions=True)
+            # Длительности поездки не зависят от даты вылета, поэтому считаются один раз
+            duration_days = date_context.get('duration_days')
+            if not duration_days:
+                # Билет в одну сторону (или дата возврата из параметров)
+                durations = [None]
+            elif isinstance(duration_days, list):
+                # Проверяем несколько вариантов длительности с адаптивным шагом в 2-3 дня
+                min_days, max_days = duration_days
+                step = max(2, (max_days - min_days) // 3)
+                logger.debug("Поиск с диапазоном длительности %d-%d дней, шаг %d дней", min_days, max_days, step)
+                durations = list(range(min_days, max_days + 1, step))
+            else:
+                durations = [duration_days]
+
+            # Все пары (вылет, возврат) строятся заранее, запросы создаются одним проходом
+            date_pairs = [
+                (
+                    date.fromordinal(search_day).isoformat(),
+                    date.fromordinal(search_day + duration).isoformat() if duration is not None else None
+                )
+                for search_day in search_days
+                for duration in durations
+            ]
+            logger.debug("Даты поиска (вылет, возврат): %s", date_pairs)
+
+            # Выполняем все запросы параллельно через общую сессию
+            session = await self._get_session()
+            base_params = self._base_search_params(params)
+            tasks = [
+                self._search_tickets_for_date(
+                    session,
+                    {**base_params, 'departure_at': departure_at, 'return_at': return_at}
+                    if return_at else {**base_params, 'departure_at': departure_at}
+                )
+                for departure_at, return_at in date_pairs
+            ]
+
+            logger.info("Всего создано %d поисковых запросов", len(tasks))
                 
-                # Собираем все успешные результаты
-                successful_results = 0
-                for result in results:
-                    if isinstance(result, dict) and result.get('success') and result.get('data'):
-                        all_tickets.extend(result['data'])
-                        successful_results += 1
+            # Выполняем все запросы параллельно, не дожидаясь отстающих, если билеты уже есть
+            results, late_requests = await self._gather_with_soft_timeout(tasks)
+            if late_requests:
+                logger.warning("Не дождались %d из %d запросов, ранжируем найденное", late_requests, len(tasks))
                 
-                logger.info(f"Успешно выполнено {successful_results} из {len(tasks)} запросов")
-                logger.info(f"Всего найдено {len(all_tickets)} билетов")
+            # Собираем все успешные результаты
+            successful_results = sum(
+                1 for result in results
+                if isinstance(result, dict) and result.get('success') and result.get('data')
+            )
+            all_tickets = self._merge_results(results)
+
+            logger.info("Успешно выполнено %d из %d запросов, найдено %d билетов (%d до удаления дубликатов)",
+                        successful_results, len(tasks), len(all_tickets),
+                        sum(len(result['data']) for result in results if isinstance(result, dict) and result.get('data')))
 
             if not all_tickets:
                 return {"success": False, "error": "No tickets found"}
             
-            # Ранжируем все найденные билеты
-            ranked_tickets = self._rank_tickets(all_tickets)
+            # Ранжируем все найденные билеты; большой список ранжируем в потоке,
+            # чтобы не блокировать event loop для остальных пользователей
+            if len(all_tickets) >= self.RANK_IN_THREAD_MIN_TICKETS:
+                ranked_tickets = await asyncio.to_thread(self._rank_tickets, all_tickets, 10)
+            else:
+                ranked_tickets = self._rank_tickets(all_tickets, 10)
             
-            return {
+            result = {
                 "success": True,
                 "data": ranked_tickets[:10],  # Возвращаем топ-10 лучших вариантов
                 "total_found": len(all_tickets)
             }
+            if not late_requests:
+                # Неполный результат не кэшируем: повторный поиск возьмет все даты из кэша запросов
+                self._results_cache.set(cache_key, self._copy_result(result))
+            return result
             
         except Exception as e:
-            logger.error(f"Error in search_tickets_with_flexible_dates: {str(e)}")
+            logger.error("Ошибка при поиске билетов с гибкими датами: %s", e)
             return {"success": False, "error": str(e)}
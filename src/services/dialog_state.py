@@ -1,16 +1,25 @@
 """
 Управление состоянием диалога с пользователем.
 """
-from dataclasses import dataclass
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from typing import Optional, Dict
-from datetime import datetime, timedelta
+from datetime import date
 import logging
-import json
+import re
 
 logger = logging.getLogger(__name__)
 
+# Формат даты YYYY-MM-DD: date.fromisoformat в Python 3.11 принимает и другие формы ISO 8601
+_ISO_DATE_MATCH = re.compile(r'\A[0-9]{4}-[0-9]{2}-[0-9]{2}\Z').match
+
 class DialogState:
     """Состояние диалога с пользователем"""
+    __slots__ = ('user_id', 'origin', 'destination', 'origin_city', 'destination_city',
+                 'departure_at', 'return_at', 'date_context', '_departure_date', '_return_date',
+                 '_search_params')
+
     def __init__(self, user_id: int):
         self.user_id = user_id
         self.origin = None  # IATA код города отправления
@@ -20,12 +29,30 @@ class DialogState:
         self.departure_at = None  # Дата вылета
         self.return_at = None  # Дата возврата
         self.date_context = None  # Контекст дат (гибкие даты, начало месяца и т.д.)
+        self._departure_date = None  # Разобранная дата вылета
+        self._return_date = None  # Разобранная дата возврата
+        self._search_params = None  # Кэш результата to_search_params
+
+    @staticmethod
+    def _parse_date(value) -> Optional[date]:
+        """Разбор даты в формате YYYY-MM-DD, None при некорректном значении"""
+        try:
+            return date.fromisoformat(value) if value and _ISO_DATE_MATCH(value) else None
+        except (TypeError, ValueError):
+            return None
+
+    @property
+    def return_days(self) -> Optional[int]:
+        """Длительность поездки в днях, если указана дата возврата"""
+        if self._departure_date and self._return_date:
+            return (self._return_date - self._departure_date).days
+        return None
 
     @property
     def is_complete(self) -> bool:
         """Проверяет, заполнены ли все обязательные параметры"""
-        return all([self.origin, self.destination, self.departure_at, self.origin_city, self.destination_city])
-    
+        return all([self.origin, self.destination, self._departure_date, self.origin_city, self.destination_city])
+
     def get_missing_params(self) -> list[str]:
         """Возвращает список недостающих параметров"""
         missing = []
@@ -33,36 +60,60 @@ class DialogState:
             missing.append("город отправления")
         if not self.destination or not self.destination_city:
             missing.append("город прибытия")
-        if not self.departure_at:
+        if not self._departure_date:
             missing.append("дату вылета")
         return missing
 
     def update_from_params(self, params: Dict) -> None:
         """Обновление состояния из параметров"""
         try:
-            logger.info(f"Обновление состояния из параметров: {json.dumps(params, ensure_ascii=False)}")
+            logger.debug("Обновление состояния из параметров: %s", params)
             
             # Обновляем все поля, которые есть в параметрах
-            for field in ['origin', 'destination', 'origin_city', 'destination_city', 
-                         'departure_at', 'return_at', 'date_context']:
-                if field in params:
-                    setattr(self, field, params[field])
-            
-            logger.info(f"Состояние после обновления: origin={self.origin}, destination={self.destination}, "
-                       f"origin_city={self.origin_city}, destination_city={self.destination_city}, "
-                       f"departure_at={self.departure_at}, return_at={self.return_at}, "
-                       f"date_context={json.dumps(self.date_context, ensure_ascii=False) if self.date_context else None}")
+            if 'origin' in params:
+                self.origin = params['origin']
+            if 'destination' in params:
+                self.destination = params['destination']
+            if 'origin_city' in params:
+                self.origin_city = params['origin_city']
+            if 'destination_city' in params:
+                self.destination_city = params['destination_city']
+            if 'departure_at' in params:
+                self.departure_at = params['departure_at']
+            if 'return_at' in params:
+                self.return_at = params['return_at']
+            if 'date_context' in params:
+                self.date_context = params['date_context']
+
+            # Даты разбираются один раз здесь, а не при каждом обращении
+            self._departure_date = self._parse_date(self.departure_at)
+            self._return_date = self._parse_date(self.return_at)
+            self._search_params = None
+
+            logger.debug(
+                "Состояние после обновления: origin=%s, destination=%s, origin_city=%s, destination_city=%s, "
+                "departure_at=%s, return_at=%s, date_context=%s",
+                self.origin, self.destination, self.origin_city, self.destination_city,
+                self.departure_at, self.return_at, self.date_context
+            )
         except Exception as e:
-            logger.error(f"Ошибка при обновлении состояния: {str(e)}", exc_info=True)
+            logger.error("Ошибка при обновлении состояния: %s", e, exc_info=True)
 
     def to_search_params(self) -> Dict:
-        """Преобразование состояния в параметры для поиска"""
+        """Преобразование состояния в параметры для поиска.
+
+        Результат кэшируется до следующего update_from_params, поэтому вызывающий
+        код не должен изменять возвращаемый словарь.
+        """
+        if self._search_params is not None:
+            return self._search_params
+
         try:
             # Проверяем наличие обязательных полей
             required_fields = ['origin', 'destination', 'departure_at']
             for field in required_fields:
                 if not getattr(self, field):
-                    logger.warning(f"Отсутствует обязательное поле {field}")
+                    logger.warning("Отсутствует обязательное поле %s", field)
                     return {}
 
             # Создаем словарь параметров только с непустыми значениями
@@ -79,25 +130,72 @@ class DialogState:
             if self.date_context:
                 params['date_context'] = self.date_context
 
-            logger.info(f"Параметры поиска: {json.dumps(params, ensure_ascii=False)}")
+            logger.info("Параметры поиска: %s", params)
+            self._search_params = params
             return params
 
         except Exception as e:
-            logger.error(f"Ошибка при создании параметров поиска: {str(e)}", exc_info=True)
+            logger.error("Ошибка при создании параметров поиска: %s", e, exc_info=True)
             return {}
 
 class DialogStateManager:
     """Менеджер состояний диалогов"""
-    def __init__(self):
-        self.states: Dict[int, DialogState] = {}
+    MAX_STATES = 50_000
+
+    def __init__(self, max_states: int = MAX_STATES):
+        self.max_states = max_states
+        # Порядок вставки используется для вытеснения давно неактивных диалогов (LRU)
+        self.states: OrderedDict[int, DialogState] = OrderedDict()
+        # Блокировки пользователей хранятся отдельно от состояний: очистка состояния
+        # не должна выдавать новую блокировку, пока обрабатывается предыдущее сообщение
+        self._locks: OrderedDict[int, asyncio.Lock] = OrderedDict()
+        # Сколько обработчиков держат или ждут блокировку пользователя
+        self._lock_users: dict[int, int] = {}
     
     def get_state(self, user_id: int) -> DialogState:
         """Получает или создает состояние диалога для пользователя"""
-        if user_id not in self.states:
-            self.states[user_id] = DialogState(user_id)
-        return self.states[user_id]
+        state = self.states.get(user_id)
+        if state is None:
+            state = self.states[user_id] = DialogState(user_id)
+            if len(self.states) > self.max_states:
+                self.states.popitem(last=False)
+        else:
+            self.states.move_to_end(user_id)
+        return state
     
     def clear_state(self, user_id: int) -> None:
         """Очищает состояние диалога пользователя"""
-        if user_id in self.states:
-            del self.states[user_id]
+        self.states.pop(user_id, None)
+
+    def _get_lock(self, user_id: int) -> asyncio.Lock:
+        """Блокировка пользователя; давно неиспользуемые блокировки без обработчиков вытесняются"""
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+            if len(self._locks) > self.max_states:
+                # Блокировку, которую кто-то держит или ждет (в том числе уже разбуженный,
+                # но еще не захвативший ее обработчик), вытеснять нельзя
+                oldest_id = next(iter(self._locks))
+                if not self._lock_users.get(oldest_id):
+                    self._locks.popitem(last=False)
+        else:
+            self._locks.move_to_end(user_id)
+        return lock
+
+    @asynccontextmanager
+    async def with_state(self, user_id: int):
+        """Состояние диалога под блокировкой пользователя.
+
+        Сообщения одного пользователя обрабатываются по очереди и не перезаписывают
+        состояние друг друга, разные пользователи друг друга не ждут.
+        """
+        lock = self._get_lock(user_id)
+        self._lock_users[user_id] = self._lock_users.get(user_id, 0) + 1
+        try:
+            async with lock:
+                yield self.get_state(user_id)
+        finally:
+            if self._lock_users[user_id] == 1:
+                del self._lock_users[user_id]
+            else:
+                self._lock_users[user_id] -= 1
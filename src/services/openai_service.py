@@ -1,230 +1,428 @@
 """
 Сервис для работы с OpenAI API.
 """
-import json
+import asyncio
+import copy
+import hashlib
 import logging
-from openai import AsyncOpenAI
+import orjson
+from openai import AsyncOpenAI, DefaultAioHttpClient
 from ..config import Config
-from datetime import datetime, timedelta
-from typing import Dict
+from ..utils.cache import TTLCache
+from ..utils.cities import find_city, find_city_by_code
+from .prompts import (
+    EXTRACT_RESPONSE_FORMAT, EXTRACT_SYSTEM_PROMPT, PROMPT_VERSION, RANK_RESPONSE_FORMAT,
+    RANK_SYSTEM_MESSAGE,
+)
+from datetime import date, datetime, timedelta
+from typing import Optional
 import re
+import unicodedata
 
 logger = logging.getLogger(__name__)
 
+# Шаблоны быстрого локального разбора простых запросов вида "из X в Y 15 июня"
+_ORIGIN_RE = re.compile(r'\bиз\s+([а-яё-]+)')
+_DESTINATION_RE = re.compile(r'\b(?:в|во|до)\s+([а-яё-]+)')
+_ISO_DATE_RE = re.compile(r'\b(\d{4})-(\d{2})-(\d{2})\b')
+_NUMERIC_DATE_RE = re.compile(r'\b(\d{1,2})\.(\d{1,2})(?:\.(\d{4}))?\b')
+_MONTHS = {
+    'января': 1, 'февраля': 2, 'марта': 3, 'апреля': 4, 'мая': 5, 'июня': 6,
+    'июля': 7, 'августа': 8, 'сентября': 9, 'октября': 10, 'ноября': 11, 'декабря': 12,
+}
+_TEXT_DATE_RE = re.compile(r'\b(\d{1,2})\s+(' + '|'.join(_MONTHS) + r')(?:\s+(\d{4}))?')
+# "в начале июня" и длительность поездки "на неделю", "на 2 недели", "на 15-20 дней"
+_START_OF_MONTH_RE = re.compile(r'\bв\s+начале\s+(' + '|'.join(_MONTHS) + r')\b')
+_DURATION_RE = re.compile(r'\bна\s+(?:(\d{1,2})\s*-\s*)?(\d{1,2})?\s*(день|дн[яейи]|недел[юиь])')
+# Пара городов через дефис или стрелку: "Москва - Париж", "москва→париж", "MOW-PAR"
+_CITY_PAIR_RE = re.compile(r'\b([а-яё]+(?:-[а-яё]+)?)\s*[-–—→]\s*([а-яё]+(?:-[а-яё]+)?)\b')
+_IATA_PAIR_RE = re.compile(r'\b([A-Z]{3})\s*[-–—→]\s*([A-Z]{3})\b')
+# IATA код города: три заглавные латинские буквы
+_IATA_MATCH = re.compile(r'\A[A-Z]{3}\Z').match
+# Знаки препинания, которые не влияют на смысл запроса при сравнении в кэше
+_PUNCTUATION_RE = re.compile(r'[^\w\s-]')
+# Признаки запросов, которые требуют разбора моделью: обратный билет, длительность, гибкие даты
+_COMPLEX_REQUEST_RE = re.compile(
+    r'обратн|недел|дн[яейи]|начал|конц|конец|середин|выходн|через|месяц|позже|раньше|примерно|около'
+)
+
+# Общие клиенты OpenAI по адресу сервера (None - OpenAI)
+_clients: dict[Optional[str], AsyncOpenAI] = {}
+
+def get_openai_client(base_url: Optional[str] = None) -> AsyncOpenAI:
+    """Общий клиент OpenAI: пул соединений и TLS-сессии переиспользуются всеми экземплярами сервиса.
+
+    base_url задает OpenAI-совместимый сервер (например, локальный vLLM) вместо OpenAI.
+
+    Транспорт на aiohttp вместо httpx лучше держит большое число одновременных запросов.
+    SDK сам повторяет запросы при 429/5xx, таймаутах и сетевых ошибках с экспоненциальной задержкой;
+    таймаут одной попытки ограничен, чтобы зависший запрос не держал пользователя минутами.
+    """
+    if (client := _clients.get(base_url)) is None:
+        client = _clients[base_url] = AsyncOpenAI(
+            api_key=Config.OPENAI_API_KEY, base_url=base_url, max_retries=3, timeout=20.0,
+            http_client=DefaultAioHttpClient()
+        )
+    return client
+
+async def aclose() -> None:
+    """Закрытие общих клиентов OpenAI при остановке; следующий get_openai_client создаст новый клиент"""
+    clients = list(_clients.values())
+    _clients.clear()
+    await asyncio.gather(*(client.close() for client in clients))
+
+def _drop_nulls(params: dict) -> dict:
+    """Параметры без null-значений: отсутствующее в запросе поле не должно затирать состояние диалога"""
+    params = {key: value for key, value in params.items() if value is not None}
+    if isinstance(params.get('date_context'), dict):
+        params['date_context'] = {key: value for key, value in params['date_context'].items() if value is not None}
+    return params
+
+def normalize_text(text: str) -> str:
+    """Нормализация текста запроса для ключа кэша"""
+    # NFKC сводит к одному виду совместимые символы (например, неразрывные пробелы и лигатуры)
+    text = _PUNCTUATION_RE.sub(' ', unicodedata.normalize('NFKC', text).lower())
+    return ' '.join(text.split())
+
+# Поля билета, по которым модель ранжирует; остальные (ссылки, коды рейсов) только увеличивают запрос
+_RANK_FIELDS = ('price', 'duration_to', 'duration_back', 'transfers', 'return_transfers', 'departure_at', 'return_at')
+
+def _rank_payload(tickets: list) -> list:
+    """Билеты для запроса ранжирования: только поля, влияющие на порядок, в исходном порядке"""
+    return [
+        {field: value for field in _RANK_FIELDS if (value := ticket.get(field)) is not None}
+        for ticket in tickets
+    ]
+
+def _find_city_pair(text: str, text_lower: str) -> tuple:
+    """Города из пары вида "Москва - Париж" или "MOW-PAR": (город вылета, город назначения) или (None, None)"""
+    if match := _IATA_PAIR_RE.search(text):
+        return find_city_by_code(match.group(1)), find_city_by_code(match.group(2))
+    for match in _CITY_PAIR_RE.finditer(text_lower):
+        origin, destination = find_city(match.group(1)), find_city(match.group(2))
+        if origin and destination:
+            return origin, destination
+    return None, None
+
+class _RequestAbandoned(Exception):
+    """Запрос к модели, ответа которого ждут другие, отменен начавшим его"""
+
 class OpenAIService:
     """Сервис для работы с OpenAI API"""
-    def __init__(self):
-        self.client = AsyncOpenAI(api_key=Config.OPENAI_API_KEY)
-        self.model = "gpt-3.5-turbo"
+    CACHE_MAXSIZE = 10_000
+    CACHE_TTL = 3600  # секунд
+    # Непригодный ответ модели кэшируется ненадолго: повтор того же текста сразу дает тот же результат
+    NEGATIVE_CACHE_TTL = 60  # секунд
+    MAX_CONCURRENT_REQUESTS = Config.OPENAI_MAX_CONCURRENT_REQUESTS
+
+    def __init__(self, local_ranker=None):
+        self.client = get_openai_client()
+        self.model = Config.OPENAI_MODEL
+        # Извлечение параметров может идти в отдельную модель и на отдельный сервер
+        self.extract_model = Config.EXTRACT_MODEL
+        self.extract_client = get_openai_client(Config.EXTRACT_BASE_URL) if Config.EXTRACT_BASE_URL else None
+        self._params_cache = TTLCache(maxsize=self.CACHE_MAXSIZE, ttl=self.CACHE_TTL)
+        self._params_inflight: dict[tuple, asyncio.Future] = {}
+        # Локальный ранжировщик (AviasalesService): тот же порядок без запроса к OpenAI
+        self.local_ranker = local_ranker
+        # Всплеск сообщений не должен превращаться во всплеск запросов и ответов 429:
+        # лишние запросы ждут здесь, а не в повторах SDK
+        self._api_semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+
+    async def _create_completion(self, client: Optional[AsyncOpenAI] = None, **kwargs):
+        """Запрос к Chat Completions с ограничением числа одновременных запросов"""
+        async with self._api_semaphore:
+            return await (client or self.client).chat.completions.create(**kwargs)
+
+    async def close(self) -> None:
+        """Закрытие клиентов OpenAI и их пулов соединений.
+
+        Клиенты общие для всех экземпляров сервиса, поэтому вызывается один раз при остановке бота.
+        """
+        await aclose()
+
+    def _params_cache_key(self, text: str, current_state: dict = None, current_date: datetime = None) -> tuple:
+        """Ключ кэша извлеченных параметров"""
+        text_hash = hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+        state_hash = hashlib.sha256(
+            orjson.dumps(current_state or {}, option=orjson.OPT_SORT_KEYS)
+        ).hexdigest()
+        # Дата входит в ключ, так как относительные даты в ответе зависят от текущего дня
+        return (self.extract_model, PROMPT_VERSION, text_hash, state_hash, current_date.date().isoformat())
+
+    def _try_local_extract(self, text: str, today: date) -> dict:
+        """Разбор простых запросов без обращения к OpenAI.
+
+        Возвращает параметры, только если однозначно найдены оба города из справочника
+        и одна явная дата вылета (или начало месяца), возможно с длительностью поездки;
+        иначе пустой словарь.
+        """
+        text_lower = text.lower()
+        start_of_month = _START_OF_MONTH_RE.search(text_lower)
+        duration = _DURATION_RE.search(text_lower)
+        # Начало месяца и длительность разбираются здесь, остальные сложные случаи - моделью
+        for match in (start_of_month, duration):
+            if match:
+                text_lower = text_lower.replace(match.group(0), ' ')
+        if _COMPLEX_REQUEST_RE.search(text_lower):
+            return {}
+
+        origin = next(filter(None, map(find_city, _ORIGIN_RE.findall(text_lower))), None)
+        destination = next(filter(None, map(find_city, _DESTINATION_RE.findall(text_lower))), None)
+        if not origin and not destination:
+            origin, destination = _find_city_pair(text, text_lower)
+        if not origin or not destination or origin == destination:
+            return {}
+
+        dates = [
+            (int(year), int(month), int(day)) for year, month, day in _ISO_DATE_RE.findall(text_lower)
+        ] + [
+            (int(year) if year else None, int(month), int(day)) for day, month, year in _NUMERIC_DATE_RE.findall(text_lower)
+        ] + [
+            (int(year) if year else None, _MONTHS[month], int(day)) for day, month, year in _TEXT_DATE_RE.findall(text_lower)
+        ]
+        if start_of_month:
+            if dates:
+                return {}
+            month = _MONTHS[start_of_month.group(1)]
+            # Как и для ответа модели: месяц не позже текущего относится к следующему году
+            year = today.year + 1 if month <= today.month else today.year
+            dates = [(year, month, 1)]
+        if len(dates) != 1:
+            return {}
+
+        year, month, day = dates[0]
+        try:
+            departure = date(year or today.year, month, day)
+            # Год не указан и дата уже прошла - имеется в виду следующий год
+            if year is None and departure < today:
+                departure = date(today.year + 1, month, day)
+        except ValueError:
+            return {}
+        if departure < today:
+            return {}
+
+        params = {
+            'origin': origin[0],
+            'destination': destination[0],
+            'origin_city': origin[1],
+            'destination_city': destination[1],
+            'departure_at': departure.isoformat(),
+            'flexible_dates': bool(start_of_month)
+        }
+        date_context = {}
+        if start_of_month:
+            date_context.update(is_start_of_month=True, month_number=month)
+        if duration:
+            min_days, max_days, unit = duration.groups()
+            days_per_unit = 7 if unit.startswith('недел') else 1
+            max_days = int(max_days or 1) * days_per_unit
+            date_context['duration_days'] = [int(min_days) * days_per_unit, max_days] if min_days else max_days
+            params['return_at'] = (departure + timedelta(days=max_days)).isoformat()
+        if date_context:
+            params['date_context'] = date_context
+        return params
 
     async def extract_flight_params(self, text: str, current_state: dict = None) -> dict:
         """Извлечение параметров полета из текста"""
         try:
-            logger.info(f"Начало извлечения параметров. Текст: {text}, Текущее состояние: {json.dumps(current_state, ensure_ascii=False) if current_state else 'None'}")
+            logger.info("Начало извлечения параметров. Текст: %s", text)
+            logger.debug("Текущее состояние диалога: %s", current_state)
             
+            # Текущая дата берется один раз на запрос: разбор, ключ кэша и промпт используют одно значение
             current_date = datetime.now()
-            next_year = current_date.year + 1
-            
-            example_response = {
-                "origin": "LED",
-                "destination": "BKK",
-                "origin_city": "Санкт-Петербург",
-                "destination_city": "Бангкок",
-                "departure_at": "2024-02-01",
-                "return_at": "2024-02-15",
-                "flexible_dates": True,
-                "date_context": {
-                    "is_start_of_month": True,
-                    "month_number": 2,
-                    "duration_days": [15, 20]  # Теперь поддерживаем диапазон
-                }
-            }
-            
-            system_content = f"""Ты помощник по поиску авиабилетов. Извлеки параметры полета из текста. 
-            Текущая дата: {current_date.strftime('%Y-%m-%d')}.
-            
-            Правила обработки дат:
-            1. Если месяц не указан явно, используй ближайший подходящий месяц в будущем
-            2. Для определения года:
-               - Если указанный месяц раньше или равен текущему → используй {next_year} год
-               - Если указанный месяц позже текущего → используй {current_date.year} год
-            3. При указании "начало месяца" используй первое число месяца
-            4. Если указан диапазон дней (например, "15-20 дней"), верни его как массив [15, 20]
-            
-            Примеры (если текущий месяц декабрь {current_date.year}):
-            - "в феврале" → {next_year}-02 (так как февраль уже в следующем году)
-            - "в январе" → {next_year}-01 (так как январь уже в следующем году)
-            - "в декабре" → {next_year}-12 (так как текущий декабрь уже идет, ищем следующий)
-            
-            Верни JSON с полями:
-            - origin (IATA код города отправления, например LED для Санкт-Петербурга)
-            - destination (IATA код города назначения, например BKK для Бангкока)
-            - origin_city (название города отправления)
-            - destination_city (название города назначения)
-            - departure_at (дата вылета в формате YYYY-MM-DD)
-            - return_at (дата возвращения в формате YYYY-MM-DD, если указано)
-            - flexible_dates (true/false - если пользователю не важны точные даты)
-            - date_context (объект с дополнительной информацией о датах):
-              - is_start_of_month (true/false - если указано "начало месяца")
-              - is_mid_month (true/false - если указана середина месяца)
-              - is_end_month (true/false - если указан конец месяца)
-              - month_number (номер месяца, если указан)
-              - relative_days (количество дней относительно текущей даты, если указано "через N дней")
-              - season (лето/осень/зима/весна, если указан сезон)
-              - duration_days (число или массив [мин, макс] для диапазона длительности поездки в днях)
-
-            Примеры запросов и их обработки:
-            1. "из Москвы в Париж на 7 дней" -> duration_days: 7
-            2. "из Питера в Бангкок на 15-20 дней" -> duration_days: [15, 20]
-            3. "из Москвы в Рим на неделю" -> duration_days: 7
-            4. "из Питера в Париж на 10-14 дней" -> duration_days: [10, 14]
+            if local_params := self._try_local_extract(text, current_date.date()):
+                logger.info("Параметры полета разобраны локально: %s", local_params)
+                return local_params
+
+            cache_key = self._params_cache_key(text, current_state, current_date)
+            if (cached := self._params_cache.get(cache_key)) is not None:
+                logger.info("Параметры полета взяты из кэша")
+                return copy.deepcopy(cached)
+
+            # Одинаковые запросы, пришедшие одновременно, ждут ответа одного вызова модели (single-flight)
+            while (inflight := self._params_inflight.get(cache_key)) is not None:
+                try:
+                    params = await asyncio.shield(inflight)
+                except _RequestAbandoned:
+                    # Начавший запрос отменен: ожидающий обращается к модели сам
+                    continue
+                return copy.deepcopy(params)
+
+            future = asyncio.get_running_loop().create_future()
+            self._params_inflight[cache_key] = future
+            try:
+                params = await self._extract_with_model(text, current_state, current_date, cache_key)
+                if not params:
+                    self._params_cache.set(cache_key, {}, ttl=self.NEGATIVE_CACHE_TTL)
+                future.set_result(params)
+                return copy.deepcopy(params)
+            except BaseException as e:
+                # Отмена начавшего запрос не должна отменять ожидающих
+                future.set_exception(e if isinstance(e, Exception) else _RequestAbandoned())
+                future.exception()  # ожидающих может не быть, помечаем исключение как полученное
+                raise
+            finally:
+                self._params_inflight.pop(cache_key, None)
             
-            Правила обработки дат:
-            1. Если указаны неточные даты ("в начале месяца", "где-то в июне") - установи flexible_dates в true
-            2. Если указана длительность поездки - укажи в duration_days
-            3. Если год не указан и дата уже прошла в текущем году - используй следующий год
-            4. Для относительных дат ("через неделю", "через 5 дней") - укажи relative_days
-            5. При указании сезона - установи соответствующий месяц (лето: июнь-август, осень: сентябрь-ноябрь и т.д.)
+        except Exception as e:
+            logger.error("Критическая ошибка при извлечении параметров полета: %s", e, exc_info=True)
+            return {}
 
-            Пример запроса: "{text}"
-            Пример ответа: {json.dumps(example_response, ensure_ascii=False, indent=2)}"""
+    async def _extract_with_model(
+        self, text: str, current_state: Optional[dict], current_date: datetime, cache_key: tuple
+    ) -> dict:
+        """Извлечение параметров полета моделью; успешный результат сохраняется в кэш"""
+        request_body = self._extract_request_body(text, current_state, current_date)
+        logger.debug("Отправка запроса к OpenAI. Сообщения: %s", request_body["messages"])
+
+        response = await self._create_completion(client=self.extract_client, **request_body)
+
+        response_text = response.choices[0].message.content
+        logger.info("Получен ответ от OpenAI: %s", response_text)
+
+        if params := self._parse_extracted_params(response_text, current_date):
+            self._params_cache.set(cache_key, copy.deepcopy(params))
+        return params
+
+    def _extract_request_body(self, text: str, current_state: Optional[dict], current_date: datetime) -> dict:
+        """Параметры запроса извлечения"""
+        # Статическая часть промпта идет первой, текущая дата и состояние диалога - в конце
+        system_content = f"{EXTRACT_SYSTEM_PROMPT}\nТекущая дата: {current_date.date().isoformat()}"
+        # Ответ на уточняющий вопрос ("в Париж") содержит не все параметры: остальные берутся из диалога
+        if known_params := {key: value for key, value in (current_state or {}).items() if value}:
+            system_content += (
+                f"\nУже известно из диалога: {orjson.dumps(known_params).decode()}. "
+                "Поля, которых нет в запросе, возьми отсюда."
+            )
 
-            messages = [
+        return {
+            "model": self.extract_model,
+            "messages": [
                 {"role": "system", "content": system_content},
                 {"role": "user", "content": text}
-            ]
+            ],
+            # Извлечение детерминировано: одинаковый запрос дает одинаковые параметры
+            "temperature": 0,
+            "max_tokens": 256,
+            "response_format": EXTRACT_RESPONSE_FORMAT
+        }
 
-            logger.debug(f"Отправка запроса к OpenAI. Сообщения: {json.dumps(messages, ensure_ascii=False)}")
-            
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=500,
-                response_format={"type": "json_object"}
-            )
-            
-            response_text = response.choices[0].message.content
-            logger.info(f"Получен ответ от OpenAI: {response_text}")
-            
-            try:
-                params = json.loads(response_text)
-                
-                # Валидация обязательных полей
-                required_fields = ['origin', 'destination', 'origin_city', 'destination_city']
-                missing_fields = [field for field in required_fields if not params.get(field)]
-                if missing_fields:
-                    logger.warning(f"Отсутствуют обязательные поля в ответе OpenAI: {', '.join(missing_fields)}")
-                    return {}
-                
-                # Валидация IATA кодов
-                for field in ['origin', 'destination']:
-                    if iata_code := params.get(field):
-                        if not (len(iata_code) == 3 and iata_code.isupper() and iata_code.isalpha()):
-                            logger.error(f"Некорректный IATA код {field}: {iata_code}")
-                            return {}
-                
-                # Обработка дат и контекста
-                if params.get('flexible_dates'):
-                    date_context = params.get('date_context', {})
-                    
-                    # Обработка начала месяца
-                    if date_context.get('is_start_of_month'):
-                        month_number = date_context.get('month_number')
-                        if month_number:
-                            current_year = datetime.now().year
-                            # Если указанный месяц меньше или равен текущему, значит это следующий год
-                            # Если указанный месяц позже текущего, оставляем текущий год
-                            if month_number <= datetime.now().month:
-                                current_year += 1
-                            params['departure_at'] = f"{current_year}-{month_number:02d}-01"
-                            
-                            # Если указана длительность, рассчитываем дату возврата
-                            if duration_days := date_context.get('duration_days'):
-                                if isinstance(duration_days, list):
-                                    min_duration, max_duration = duration_days
-                                    return_date = datetime.strptime(params['departure_at'], '%Y-%m-%d') + timedelta(days=max_duration)
-                                    params['return_at'] = return_date.strftime('%Y-%m-%d')
-                                else:
-                                    return_date = datetime.strptime(params['departure_at'], '%Y-%m-%d') + timedelta(days=duration_days)
-                                    params['return_at'] = return_date.strftime('%Y-%m-%d')
-                
-                logger.info(f"Финальные извлеченные параметры: {json.dumps(params, ensure_ascii=False)}")
-                return params
-                
-            except json.JSONDecodeError as e:
-                logger.error(f"Ошибка декодирования JSON: {str(e)}")
-                return {}
-            except Exception as e:
-                logger.error(f"Ошибка обработки ответа OpenAI: {str(e)}")
+    @staticmethod
+    def _parse_extracted_params(response_text: str, current_date: datetime) -> dict:
+        """Проверка ответа модели и расчет дат; пустой словарь, если ответ непригоден"""
+        try:
+            params = _drop_nulls(orjson.loads(response_text))
+
+            # Валидация обязательных полей
+            required_fields = ['origin', 'destination', 'origin_city', 'destination_city']
+            missing_fields = [field for field in required_fields if not params.get(field)]
+            if missing_fields:
+                logger.warning("Отсутствуют обязательные поля в ответе OpenAI: %s", ', '.join(missing_fields))
                 return {}
-            
+
+            # Валидация IATA кодов: схема ответа уже задает формат, проверка остается
+            # для совместимых API без поддержки structured outputs
+            for field in ['origin', 'destination']:
+                if iata_code := params.get(field):
+                    if not (isinstance(iata_code, str) and _IATA_MATCH(iata_code)):
+                        logger.error("Некорректный IATA код %s: %s", field, iata_code)
+                        return {}
+
+            # Обработка дат и контекста
+            if params.get('flexible_dates'):
+                date_context = params.get('date_context', {})
+
+                # Обработка начала месяца
+                if date_context.get('is_start_of_month'):
+                    month_number = date_context.get('month_number')
+                    if month_number:
+                        current_year = current_date.year
+                        # Если указанный месяц меньше или равен текущему, значит это следующий год
+                        # Если указанный месяц позже текущего, оставляем текущий год
+                        if month_number <= current_date.month:
+                            current_year += 1
+                        params['departure_at'] = f"{current_year}-{month_number:02d}-01"
+
+                        # Если указана длительность, рассчитываем дату возврата
+                        if duration_days := date_context.get('duration_days'):
+                            if isinstance(duration_days, list):
+                                min_duration, max_duration = duration_days
+                                return_date = date.fromisoformat(params['departure_at']) + timedelta(days=max_duration)
+                                params['return_at'] = return_date.isoformat()
+                            else:
+                                return_date = date.fromisoformat(params['departure_at']) + timedelta(days=duration_days)
+                                params['return_at'] = return_date.isoformat()
+
+            logger.info("Финальные извлеченные параметры: %s", params)
+            return params
+
+        except orjson.JSONDecodeError as e:
+            logger.error("Ошибка декодирования JSON: %s", e)
+            return {}
         except Exception as e:
-            logger.error(f"Критическая ошибка при извлечении параметров полета: {str(e)}", exc_info=True)
+            logger.error("Ошибка обработки ответа OpenAI: %s", e)
             return {}
 
+    @staticmethod
+    def _rank_max_tokens(ticket_count: int) -> int:
+        """Лимит ответа ранжирования: краткое описание и по одному индексу на билет"""
+        return 150 + 5 * ticket_count
+
+    def _rank_request_body(self, tickets: list) -> dict:
+        """Параметры запроса ранжирования"""
+        return {
+            "model": self.model,
+            "messages": [
+                RANK_SYSTEM_MESSAGE,
+                {"role": "user", "content": orjson.dumps(_rank_payload(tickets)).decode()}
+            ],
+            "temperature": 0,
+            "max_tokens": self._rank_max_tokens(len(tickets)),
+            "response_format": RANK_RESPONSE_FORMAT
+        }
+
+    @staticmethod
+    def _apply_ranking_order(tickets: list, result: dict) -> dict:
+        """Ответ модели (индексы билетов) в формате ранжирования с исходными билетами.
+
+        Некорректные и повторные индексы отбрасываются, пропущенные моделью билеты идут в конце.
+        """
+        ranked_indices = []
+        seen = set()
+        for index in result.get('order') or []:
+            # bool - подкласс int, поэтому true/false в ответе модели отбрасываются явно
+            if type(index) is int and 0 <= index < len(tickets) and index not in seen:
+                seen.add(index)
+                ranked_indices.append(index)
+        ranked_indices.extend(index for index in range(len(tickets)) if index not in seen)
+        return {
+            "ranked_tickets": [tickets[index] for index in ranked_indices],
+            "summary": result.get('summary', '')
+        }
+
     async def rank_tickets(self, tickets: list) -> dict:
         """Ранжирование билетов"""
+        if not Config.USE_LLM_RANKING and self.local_ranker is not None:
+            return self.local_ranker.rank_tickets(tickets)
+
         try:
-            logger.info("Входные данные для ранжирования:")
-            for ticket in tickets:
-                logger.info(f"Билет до ранжирования: {json.dumps(ticket, ensure_ascii=False)}")
-
-            system_content = """Ранжируй билеты по следующим критериям (в порядке приоритета):
-1. Минимальная цена (price) — главный критерий.
-2. Минимальное время в пути (duration_to, duration_back) — важнее, если разница в цене меньше 20%.
-3. Наименьшее число пересадок (transfers) — в случае одинаковой цены и времени в пути.
-4. Удобное время вылета (6:00-23:00) — применяй, если остальные критерии равны.
-
-ВАЖНО: Сохраняй ВСЕ поля билета без изменений:
-- Точные значения длительности полета (duration_to, duration_back)
-- Все временные метки и цены
-- Все остальные поля, включая link
-
-Для ранжирования используй весовые коэффициенты:
-- Цена: вес 5
-- Время в пути: вес 4
-- Количество пересадок: вес 2
-- Время вылета: вес 1
-
-Формат ответа JSON:
-{
-    "ranked_tickets": [
-        {
-            "price": число,
-            "origin": "IATA код города отправления",
-            "destination": "IATA код города назначения",
-            "origin_city": "название города отправления",
-            "destination_city": "название города назначения",
-            "departure_at": "YYYY-MM-DDTHH:mm:ss",
-            "arrival_at": "YYYY-MM-DDTHH:mm:ss",
-            "duration_to": число,
-            "duration_back": число,
-            "transfers": число,
-            "return_at": "YYYY-MM-DDTHH:mm:ss или null",
-            "link": "оригинальная ссылка без изменений"
-        }
-    ],
-    "summary": "Краткое описание ранжирования"
-}"""
-
-            response = await self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": system_content},
-                    {"role": "user", "content": json.dumps(tickets, ensure_ascii=False)}
-                ],
-                response_format={"type": "json_object"}
-            )
+            if logger.isEnabledFor(logging.DEBUG):
+                for ticket in tickets:
+                    logger.debug("Билет до ранжирования: %s", ticket)
+
+            response = await self._create_completion(**self._rank_request_body(tickets))
             
-            result = json.loads(response.choices[0].message.content)
+            # Модель возвращает только порядок индексов, билеты берутся из исходного списка
+            result = self._apply_ranking_order(tickets, orjson.loads(response.choices[0].message.content))
             
-            logger.info(f"Ранжированные билеты: {len(result.get('ranked_tickets', []))}")
-            for ticket in result.get('ranked_tickets', []):
-                logger.info(f"Билет после ранжирования: {json.dumps(ticket, ensure_ascii=False)}")
+            logger.info("Ранжирование билетов: на входе %d, в ответе %d", len(tickets), len(result['ranked_tickets']))
+            if logger.isEnabledFor(logging.DEBUG):
+                for ticket in result['ranked_tickets']:
+                    logger.debug("Билет после ранжирования: %s", ticket)
             
             return result
 
         except Exception as e:
-            logger.error(f"Ошибка ранжирования билетов: {e}", exc_info=True)
+            logger.error("Ошибка ранжирования билетов: %s", e, exc_info=True)
             return None
@@ -0,0 +1,113 @@
+"""
+Промпты и схемы ответов OpenAI.
+"""
+import json
+from typing import Final
+
+# Версия промпта извлечения параметров: увеличивать при любом изменении промпта,
+# чтобы не отдавать из кэша ответы, полученные на старой версии
+PROMPT_VERSION: Final = 4
+
+# Пример ответа для промпта извлечения параметров, сериализуется один раз при импорте
+# (json, а не orjson: пробелы после разделителей сохраняют текст промпта прежним)
+_EXTRACT_EXAMPLE = json.dumps({
+    "origin": "LED",
+    "destination": "BKK",
+    "origin_city": "Санкт-Петербург",
+    "destination_city": "Бангкок",
+    "departure_at": "2025-02-01",
+    "return_at": "2025-02-21",
+    "flexible_dates": True,
+    "date_context": {"is_start_of_month": True, "month_number": 2, "duration_days": [15, 20]}
+}, ensure_ascii=False)
+
+# Промпты не зависят от запроса и собираются один раз при импорте
+EXTRACT_SYSTEM_PROMPT: Final = f"""Извлеки параметры авиаперелета из запроса. Верни JSON:
+origin, destination - IATA коды городов (LED, BKK);
+origin_city, destination_city - названия городов;
+departure_at, return_at - даты YYYY-MM-DD (return_at только если указан);
+flexible_dates - true, если точная дата не важна ("в начале месяца", "где-то в июне");
+date_context - is_start_of_month, is_mid_month, is_end_month (true/false), month_number,
+relative_days ("через N дней"), season (лето/осень/зима/весна),
+duration_days - длительность поездки: число или [мин, макс] ("на неделю" - 7, "на 15-20 дней" - [15, 20]).
+Год не указан - ближайшая будущая дата: месяц раньше текущего или равен ему - следующий год.
+Начало месяца - 1 число. Сезон - его первый месяц.
+Пример: "из Питера в Бангкок в начале февраля на 15-20 дней" -> {_EXTRACT_EXAMPLE}"""
+
+RANK_SYSTEM_PROMPT: Final = """Ранжируй авиабилеты, лучшие первыми. Критерии по убыванию веса:
+цена price (5); время в пути duration_to + duration_back (4, решает при разнице цен меньше 20%);
+пересадки transfers (2); вылет с 6:00 до 23:00 (1).
+Верни JSON {"order": [индексы билетов во входном массиве от лучшего к худшему], "summary": "кратко о выборе"}"""
+
+# Системное сообщение ранжирования не меняется между запросами и передается как есть
+RANK_SYSTEM_MESSAGE: Final = {"role": "system", "content": RANK_SYSTEM_PROMPT}
+
+# Схемы ответов (structured outputs): модель не может вернуть JSON другой формы.
+# Необязательные поля в строгом режиме задаются как nullable, null-значения отбрасываются после разбора
+_NULLABLE_STRING = {"type": ["string", "null"]}
+_NULLABLE_IATA = {"type": ["string", "null"], "pattern": "^[A-Z]{3}$"}
+_NULLABLE_BOOLEAN = {"type": ["boolean", "null"]}
+_NULLABLE_INTEGER = {"type": ["integer", "null"]}
+
+_DATE_CONTEXT_SCHEMA = {
+    "type": ["object", "null"],
+    "properties": {
+        "is_start_of_month": _NULLABLE_BOOLEAN,
+        "is_mid_month": _NULLABLE_BOOLEAN,
+        "is_end_month": _NULLABLE_BOOLEAN,
+        "month_number": _NULLABLE_INTEGER,
+        "relative_days": _NULLABLE_INTEGER,
+        "season": _NULLABLE_STRING,
+        "duration_days": {"anyOf": [
+            {"type": "integer"},
+            {"type": "array", "items": {"type": "integer"}},
+            {"type": "null"}
+        ]}
+    },
+    "required": [
+        "is_start_of_month", "is_mid_month", "is_end_month",
+        "month_number", "relative_days", "season", "duration_days"
+    ],
+    "additionalProperties": False
+}
+
+EXTRACT_RESPONSE_FORMAT: Final = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "flight_params",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "origin": _NULLABLE_IATA,
+                "destination": _NULLABLE_IATA,
+                "origin_city": _NULLABLE_STRING,
+                "destination_city": _NULLABLE_STRING,
+                "departure_at": _NULLABLE_STRING,
+                "return_at": _NULLABLE_STRING,
+                "flexible_dates": {"type": "boolean"},
+                "date_context": _DATE_CONTEXT_SCHEMA
+            },
+            "required": [
+                "origin", "destination", "origin_city", "destination_city",
+                "departure_at", "return_at", "flexible_dates", "date_context"
+            ],
+            "additionalProperties": False
+        }
+    }
+}
+
+_RANKING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "order": {"type": "array", "items": {"type": "integer", "minimum": 0}},
+        "summary": {"type": "string"}
+    },
+    "required": ["order", "summary"],
+    "additionalProperties": False
+}
+
+RANK_RESPONSE_FORMAT: Final = {
+    "type": "json_schema",
+    "json_schema": {"name": "ranking", "strict": True, "schema": _RANKING_SCHEMA}
+}
@@ -0,0 +1,10 @@
+"""
+Общие экземпляры сервисов приложения.
+"""
+from .aviasales_service import AviasalesService
+from .dialog_state import DialogStateManager
+from .openai_service import OpenAIService
+
+aviasales_service = AviasalesService()
+openai_service = OpenAIService(local_ranker=aviasales_service)
+dialog_manager = DialogStateManager()
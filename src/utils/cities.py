@@ -0,0 +1,66 @@
+"""
+Справочник популярных городов и их IATA кодов.
+"""
+from types import MappingProxyType
+from typing import Optional
+
+# Название города -> (IATA код, формы названия в падежах, встречающихся в запросах)
+CITIES = {
+    'Москва': ('MOW', ['москвы', 'москву', 'мск']),
+    'Санкт-Петербург': ('LED', ['санкт-петербурга', 'петербург', 'петербурга', 'питер', 'питера', 'спб']),
+    'Казань': ('KZN', ['казани']),
+    'Сочи': ('AER', []),
+    'Екатеринбург': ('SVX', ['екатеринбурга', 'екб']),
+    'Новосибирск': ('OVB', ['новосибирска']),
+    'Калининград': ('KGD', ['калининграда']),
+    'Краснодар': ('KRR', ['краснодара']),
+    'Самара': ('KUF', ['самары', 'самару']),
+    'Владивосток': ('VVO', ['владивостока']),
+    'Минск': ('MSQ', ['минска']),
+    'Тбилиси': ('TBS', []),
+    'Ереван': ('EVN', ['еревана']),
+    'Баку': ('BAK', []),
+    'Алматы': ('ALA', []),
+    'Ташкент': ('TAS', ['ташкента']),
+    'Стамбул': ('IST', ['стамбула']),
+    'Анталья': ('AYT', ['анталью', 'антальи', 'анталия', 'анталию', 'анталии']),
+    'Дубай': ('DXB', ['дубая']),
+    'Париж': ('PAR', ['парижа']),
+    'Барселона': ('BCN', ['барселоны', 'барселону']),
+    'Рим': ('ROM', ['рима']),
+    'Милан': ('MIL', ['милана']),
+    'Мадрид': ('MAD', ['мадрида']),
+    'Лондон': ('LON', ['лондона']),
+    'Берлин': ('BER', ['берлина']),
+    'Прага': ('PRG', ['праги', 'прагу']),
+    'Вена': ('VIE', ['вены', 'вену']),
+    'Амстердам': ('AMS', ['амстердама']),
+    'Бангкок': ('BKK', ['бангкока']),
+    'Пхукет': ('HKT', ['пхукета']),
+    'Пекин': ('BJS', ['пекина']),
+    'Токио': ('TYO', []),
+    'Нью-Йорк': ('NYC', ['нью-йорка']),
+}
+
+def _normalize(word: str) -> str:
+    """Нормализация формы названия для поиска в справочнике"""
+    return word.lower().replace('ё', 'е')
+
+# Нормализованная форма названия -> (IATA код, название города).
+# Справочник строится один раз при импорте и не меняется во время работы
+CITY_LOOKUP = MappingProxyType({
+    _normalize(form): (code, name)
+    for name, (code, forms) in CITIES.items()
+    for form in [name, *forms]
+})
+
+# IATA код -> (IATA код, название города)
+CODE_LOOKUP = MappingProxyType({code: (code, name) for name, (code, _) in CITIES.items()})
+
+def find_city(word: str) -> Optional[tuple[str, str]]:
+    """Поиск города по форме названия: (IATA код, название) или None"""
+    return CITY_LOOKUP.get(_normalize(word))
+
+def find_city_by_code(code: str) -> Optional[tuple[str, str]]:
+    """Поиск города по IATA коду: (IATA код, название) или None"""
+    return CODE_LOOKUP.get(code)
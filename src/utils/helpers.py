@@ -1,18 +1,39 @@
 """
 Вспомогательные функции.
 """
+import functools
+from itertools import islice
 from datetime import datetime
 import logging
+import re
 logger = logging.getLogger(__name__)
 
+AVIASALES_URL = "https://www.aviasales.ru"
+MAX_TICKETS_IN_MESSAGE = 5
+NOT_FOUND_MESSAGE = "К сожалению, билеты не найдены 😔"
+FORMAT_ERROR_MESSAGE = "К сожалению, не удалось отформатировать информацию о билетах 😔"
+
+# Поля, без которых билет нельзя показать
+_REQUIRED_TICKET_FIELDS = ('link', 'price', 'departure_at')
+
+# Дата и время в формате API: YYYY-MM-DDTHH:MM, далее секунды и часовой пояс
+_ISO_DATETIME_MATCH = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}').match
+
+# Форматирование чистое и повторяется для тех же значений у разных билетов и пользователей,
+# поэтому результаты кэшируются
+@functools.lru_cache(maxsize=4096)
 def format_date(date_str: str) -> str:
     """Форматирование даты и времени"""
     try:
+        # Время показывается в часовом поясе из API, поэтому достаточно переставить части строки
+        if _ISO_DATETIME_MATCH(date_str):
+            return f"{date_str[8:10]}.{date_str[5:7]}.{date_str[0:4]} {date_str[11:13]}:{date_str[14:16]}"
         dt = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
         return dt.strftime('%d.%m.%Y %H:%M')
     except Exception:
         return date_str
 
+@functools.lru_cache(maxsize=1024)
 def format_duration(minutes: int) -> str:
     """Форматирование длительности полета"""
     if not minutes:
@@ -28,6 +49,7 @@ def format_duration(minutes: int) -> str:
     else:
         return f"{hours}ч {mins}мин"
 
+@functools.lru_cache(maxsize=1024)
 def format_price(price: int) -> str:
     """Форматирование цены"""
     return f"{price:,}₽".replace(',', ' ')
@@ -36,69 +58,55 @@ def format_ticket_message(tickets_data: list | dict) -> str:
     """Форматирование сообщения с билетами"""
     if isinstance(tickets_data, dict):
         if not tickets_data or not tickets_data.get('success') or not tickets_data.get('data'):
-            return "К сожалению, билеты не найдены 😔"
+            return NOT_FOUND_MESSAGE
         tickets = tickets_data['data']
         currency = tickets_data.get('currency', 'RUB').upper()
     else:
         if not tickets_data:
-            return "К сожалению, билеты не найдены 😔"
+            return NOT_FOUND_MESSAGE
         tickets = tickets_data
         currency = 'RUB'
 
-    message_parts = []
-    
-    for i, ticket in enumerate(tickets[:5], 1):
-        try:
-            # Форматируем даты
-            departure_at = format_date(ticket['departure_at'])
-            return_at = format_date(ticket['return_at']) if ticket.get('return_at') else None
-            
-            # Форматируем длительность
-            duration_to = format_duration(ticket.get('duration_to', 0))
-            duration_back = format_duration(ticket.get('duration_back', 0)) if ticket.get('return_at') else None
-            
-            # Определяем наличие пересадок
-            transfers = int(ticket.get('transfers', 0))
-            return_transfers = int(ticket.get('return_transfers', 0)) if ticket.get('return_transfers') is not None else None
-            
-            # Формируем ссылку на билет
-            price = format_price(ticket['price'])
-            ticket_url = f"https://www.aviasales.ru{ticket['link']}"
-            
-            # Формируем сообщение для одного билета
-            ticket_message = [
-                f"\n🎫 Вариант {i}:",
-                f"💰 <a href='{ticket_url}'>{price}</a> {currency}",
-                f"✈️ Туда: {departure_at}"
-            ]
-            
-            # Добавляем информацию о пересадках для полета туда
-            if transfers == 0:
-                ticket_message.append(f"⭐️ Прямой рейс ({duration_to})")
-            else:
-                transfer_text = "1 пересадка" if transfers == 1 else f"{transfers} пересадки" if 2 <= transfers <= 4 else f"{transfers} пересадок"
-                ticket_message.append(f"🛑 {transfer_text} ({duration_to})")
-            
-            # Добавляем информацию о обратном рейсе, если есть
-            if return_at and duration_back:
-                ticket_message.append(f"🔄 Обратно: {return_at}")
-                if return_transfers == 0:
-                    ticket_message.append(f"⭐️ Прямой рейс ({duration_back})")
-                else:
-                    return_transfer_text = "1 пересадка" if return_transfers == 1 else f"{return_transfers} пересадки" if 2 <= return_transfers <= 4 else f"{return_transfers} пересадок"
-                    ticket_message.append(f"🛑 {return_transfer_text} ({duration_back})")
-            
-            message_parts.append("\n".join(ticket_message))
-            
-        except Exception as e:
-            logger.error(f"Ошибка форматирования билета: {str(e)}")
-            continue
-    
+    message_parts = [
+        message for i, ticket in enumerate(islice(tickets, MAX_TICKETS_IN_MESSAGE), 1)
+        if (message := _format_ticket(i, ticket, currency)) is not None
+    ]
     if not message_parts:
-        return "К сожалению, не удалось отформатировать информацию о билетах 😔"
+        return FORMAT_ERROR_MESSAGE
     
     return "\n\n".join(message_parts)
 
+def _format_ticket(number: int, ticket: dict, currency: str) -> str | None:
+    """Текст одного билета; None, если билет не удалось отформатировать"""
+    # Билет без обязательных полей пропускается без исключения; try остается для некорректных значений
+    if missing := [field for field in _REQUIRED_TICKET_FIELDS if field not in ticket]:
+        logger.error("Билет без обязательных полей: %s", ', '.join(missing))
+        return None
+
+    get = ticket.get
+    try:
+        message = (
+            f"\n🎫 Вариант {number}:\n"
+            f"💰 <a href='{AVIASALES_URL}{ticket['link']}'>{format_price(ticket['price'])}</a> {currency}\n"
+            f"✈️ Туда: {format_date(ticket['departure_at'])}\n"
+            f"{format_segment(int(get('transfers', 0)), format_duration(get('duration_to', 0)))}"
+        )
+        # Информация об обратном рейсе, если он есть
+        if return_at := get('return_at'):
+            # API может не прислать пересадки обратного рейса: тогда показывается только длительность
+            return_transfers = get('return_transfers')
+            if return_transfers is not None:
+                return_transfers = int(return_transfers)
+            message += (
+                f"\n🔄 Обратно: {format_date(return_at)}\n"
+                f"{format_segment(return_transfers, format_duration(get('duration_back', 0)))}"
+            )
+        return message
+    except Exception as e:
+        logger.error("Ошибка форматирования билета: %r", e)
+        return None
+
+@functools.lru_cache(maxsize=64)
 def format_transfers(count: int) -> str:
     """Форматирование количества пересадок"""
     if count == 0:
@@ -107,3 +115,10 @@ def format_transfers(count: int) -> str:
         return "1 пересадка"
     else:
         return f"{count} пересадки" if 2 <= count <= 4 else f"{count} пересадок"
+
+def format_segment(transfers: int | None, duration: str) -> str:
+    """Строка с пересадками и длительностью для одного направления; без пересадок, если они неизвестны"""
+    if transfers is None:
+        return f"⏱ {duration}"
+    icon = "⭐️" if transfers == 0 else "🛑"
+    return f"{icon} {format_transfers(transfers)} ({duration})"
@@ -0,0 +1,48 @@
+"""
+Повтор запросов к внешним API при временных ошибках.
+"""
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+class RetryableError(Exception):
+    """Временная ошибка внешнего API (429, 5xx), после которой запрос можно повторить"""
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Ошибки сети и таймауты, при которых запрос повторяется
+RETRY_EXCEPTIONS = (aiohttp.ClientError, asyncio.TimeoutError, RetryableError)
+
+async def retry_async(
+    func: Callable[..., Awaitable[T]],
+    *args,
+    attempts: int = 3,
+    initial_delay: float = 0.5,
+    max_delay: float = 4.0,
+    retry_on: tuple = RETRY_EXCEPTIONS,
+    **kwargs
+) -> T:
+    """Вызов корутины с повторами: экспоненциальная задержка со случайным разбросом (jitter)"""
+    for attempt in range(1, attempts + 1):
+        try:
+            return await func(*args, **kwargs)
+        except retry_on as e:
+            if attempt == attempts:
+                raise
+
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after is None:
+                retry_after = random.uniform(0, min(max_delay, initial_delay * 2 ** (attempt - 1)))
+            elif retry_after > max_delay:
+                # Сервер просит ждать дольше, чем пользователь готов ждать ответа
+                raise
+            logger.warning("Попытка %d из %d не удалась (%r), повтор через %.2f с", attempt, attempts, e, retry_after)
+            await asyncio.sleep(retry_after)
@@ -0,0 +1,301 @@
+import asyncio
+import orjson
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from src.services.aviasales_service import AviasalesService
+
+TICKETS = [
+    {"price": 12000, "link": "/search/a", "departure_at": "2024-06-15T10:00:00+03:00", "duration": 300, "transfers": 1},
+    {"price": 9000, "link": "/search/b", "departure_at": "2024-06-15T07:00:00+03:00", "duration": 240, "transfers": 0},
+]
+
+def make_response(payload, status=200, headers=None):
+    """Мок ответа aiohttp"""
+    response = MagicMock()
+    response.status = status
+    response.headers = headers or {}
+    response.read = AsyncMock(return_value=orjson.dumps(payload))
+    return response
+
+def make_session(payload, status=200, delay=0, responses=None):
+    """Мок aiohttp-сессии, возвращающей заданный ответ (или ответы по очереди)"""
+    responses = iter(responses or [])
+    default_response = make_response(payload, status)
+
+    class _RequestContext:
+        async def __aenter__(self):
+            if delay:
+                await asyncio.sleep(delay)
+            return next(responses, default_response)
+
+        async def __aexit__(self, *args):
+            return False
+
+    session = MagicMock()
+    session.get = MagicMock(side_effect=lambda *args, **kwargs: _RequestContext())
+    return session
+
+@pytest.fixture
+def aviasales_service():
+    return AviasalesService()
+
+@pytest.fixture
+def params():
+    return {"origin": "MOW", "destination": "PAR", "departure_at": "2024-06-15"}
+
+@pytest.mark.asyncio
+async def test_search_for_date_cached(aviasales_service, params):
+    """Тест: повторный запрос с теми же параметрами берется из кэша"""
+    session = make_session({"success": True, "data": [dict(t) for t in TICKETS]})
+
+    first = await aviasales_service._search_tickets_for_date(session, params)
+    first['data'][0]['_score'] = 1.0  # вызывающий код может дополнять билеты
+    second = await aviasales_service._search_tickets_for_date(session, params)
+
+    assert session.get.call_count == 1
+    assert second['success']
+    assert '_score' not in second['data'][0]
+
+@pytest.mark.asyncio
+async def test_search_for_date_coalesces_concurrent_requests(aviasales_service, params):
+    """Тест: одновременные одинаковые запросы выполняются одним вызовом API"""
+    session = make_session({"success": True, "data": [dict(t) for t in TICKETS]}, delay=0.01)
+
+    results = await asyncio.gather(*[
+        aviasales_service._search_tickets_for_date(session, params) for _ in range(5)
+    ])
+
+    assert session.get.call_count == 1
+    assert all(result['success'] for result in results)
+
+@pytest.mark.asyncio
+async def test_search_for_date_error_not_cached(aviasales_service, params):
+    """Тест: ошибки API не кэшируются"""
+    session = make_session({"success": False, "error": "boom"}, status=403)
+
+    await aviasales_service._search_tickets_for_date(session, params)
+    result = await aviasales_service._search_tickets_for_date(session, params)
+
+    assert session.get.call_count == 2
+    assert not result['success']
+
+def test_merge_results_deduplicates(aviasales_service):
+    """Тест: одинаковые билеты из соседних дат не дублируются, ошибки пропускаются"""
+    results = [
+        {"success": True, "data": [dict(t) for t in TICKETS]},
+        {"success": True, "data": [dict(TICKETS[0])]},
+        RuntimeError("timeout"),
+        {"success": False, "error": "boom"},
+    ]
+
+    merged = aviasales_service._merge_results(results)
+
+    assert len(merged) == 2
+
+@pytest.mark.asyncio
+async def test_search_for_date_retries_rate_limit(aviasales_service, params):
+    """Тест: при 429 запрос повторяется после паузы из Retry-After"""
+    session = make_session(
+        {"success": True, "data": [dict(t) for t in TICKETS]},
+        responses=[make_response({"error": "rate limit"}, status=429, headers={"Retry-After": "0"})]
+    )
+
+    result = await aviasales_service._search_tickets_for_date(session, params)
+
+    assert session.get.call_count == 2
+    assert result['success']
+
+@pytest.mark.asyncio
+async def test_search_for_date_shares_inflight_failure(aviasales_service, params):
+    """Тест: ожидающие запросы получают тот же результат, что и выполняющийся, даже при ошибке"""
+    session = make_session({"success": False, "error": "forbidden"}, status=403, delay=0.01)
+
+    results = await asyncio.gather(*[
+        aviasales_service._search_tickets_for_date(session, params) for _ in range(3)
+    ])
+
+    assert session.get.call_count == 1
+    assert not any(result['success'] for result in results)
+    assert not aviasales_service._inflight
+
+def test_rank_tickets_handles_missing_duration(aviasales_service):
+    """Тест: билеты без длительности ранжируются без ошибок, лучший по оценке первый"""
+    tickets = [
+        {"origin": "MOW", "destination": "PAR", "price": 12000, "duration": 0, "transfers": 1},
+        *[dict(t, origin="MOW", destination="PAR") for t in TICKETS],
+    ]
+
+    result = aviasales_service.rank_tickets(tickets)
+
+    assert len(result['ranked_tickets']) == 3
+    assert result['ranked_tickets'][0]['price'] == 9000
+
+@pytest.mark.asyncio
+async def test_flexible_search_result_cached(aviasales_service, params):
+    """Тест: повторный поиск с гибкими датами не обращается к API и не ранжирует заново"""
+    session = make_session({"success": True, "data": [dict(t) for t in TICKETS]})
+    aviasales_service._get_session = AsyncMock(return_value=session)
+
+    first = await aviasales_service.search_tickets_with_flexible_dates(params)
+    calls = session.get.call_count
+    second = await aviasales_service.search_tickets_with_flexible_dates(params)
+
+    assert calls == 5
+    assert session.get.call_count == calls
+    assert second == first
+    assert second['data'][0] is not first['data'][0]
+
+@pytest.mark.asyncio
+async def test_search_for_date_skips_empty_query_params(aviasales_service):
+    """Тест: в запрос к API не попадают пустые параметры (билет в одну сторону)"""
+    session = make_session({"success": True, "data": [dict(t) for t in TICKETS]})
+
+    await aviasales_service._search_tickets_for_date(session, {"origin": "MOW", "departure_at": "2024-06-15"})
+
+    query_params = dict(session.get.call_args.kwargs['params'])
+    assert None not in query_params.values()
+    assert 'return_at' not in query_params
+    assert query_params['one_way'] == 'true'
+
+@pytest.mark.asyncio
+async def test_range_search_returns_cheapest_unique(aviasales_service, params):
+    """Тест: поиск по началу месяца возвращает самые дешевые билеты без дубликатов"""
+    session = make_session({"success": True, "data": [dict(t) for t in TICKETS]})
+    aviasales_service._get_session = AsyncMock(return_value=session)
+
+    result = await aviasales_service.search_tickets_in_range(
+        {**params, "date_context": {"is_start_of_month": True}}
+    )
+
+    assert session.get.call_count == 5
+    assert [ticket['price'] for ticket in result['data']] == [9000, 12000]
+
+def test_rank_tickets_prefers_fast_among_similar_prices(aviasales_service):
+    """Тест: среди близких по цене билетов выше быстрый, дорогие идут следом по цене"""
+    tickets = [
+        {"price": 30000, "link": "/c", "duration": 200, "transfers": 0},
+        {"price": 10500, "link": "/b", "duration": 180, "transfers": 0},
+        {"price": 10000, "link": "/a", "duration": 600, "transfers": 2},
+        {"price": 20000, "link": "/d", "duration": 200, "transfers": 0},
+    ]
+
+    ranked = aviasales_service._rank_tickets(tickets, limit=3)
+
+    assert [ticket['link'] for ticket in ranked] == ["/b", "/a", "/d"]
+
+@pytest.mark.asyncio
+async def test_flexible_search_does_not_wait_for_late_dates(aviasales_service, params):
+    """Тест: если билеты уже найдены, гибкий поиск отменяет отстающие запросы и не кэширует неполный результат"""
+    fast = make_session({"success": True, "data": [dict(t) for t in TICKETS]})
+    slow = make_session({"success": True, "data": []}, delay=0.2)
+    session = MagicMock()
+    session.get = MagicMock(side_effect=[fast.get(), *(slow.get() for _ in range(4))])
+    aviasales_service._get_session = AsyncMock(return_value=session)
+    aviasales_service.FLEXIBLE_SEARCH_SOFT_TIMEOUT = 0.05
+
+    result = await aviasales_service.search_tickets_with_flexible_dates(params)
+
+    assert result['success']
+    assert len(aviasales_service._results_cache) == 0
+    assert not aviasales_service._inflight
+    assert all(task.done() for task in asyncio.all_tasks() if task is not asyncio.current_task())
+
+def test_merge_results_deduplicates_same_flight_with_different_links(aviasales_service):
+    """Тест: один и тот же рейс из ответов на соседние даты считается одним билетом"""
+    flight = {"airline": "SU", "flight_number": "2460", "departure_at": "2024-06-15T10:00:00+03:00", "price": 12000}
+    results = [
+        {"success": True, "data": [dict(flight, link="/search/a?date=14")]},
+        {"success": True, "data": [dict(flight, link="/search/a?date=15")]},
+        {"success": True, "data": [dict(flight, link="/search/b", return_at="2024-06-20T10:00:00+03:00")]},
+    ]
+
+    merged = aviasales_service._merge_results(results)
+
+    assert len(merged) == 2
+
+@pytest.mark.asyncio
+async def test_flexible_search_with_duration_range(aviasales_service, params):
+    """Тест: для диапазона длительности запрашивается каждая пара дат вылета и возврата"""
+    session = make_session({"success": True, "data": [dict(t) for t in TICKETS]})
+    aviasales_service._get_session = AsyncMock(return_value=session)
+
+    await aviasales_service.search_tickets_with_flexible_dates(
+        {**params, "date_context": {"duration_days": [7, 10]}}
+    )
+
+    pairs = {
+        (query['departure_at'], query['return_at'])
+        for query in (dict(call.kwargs['params']) for call in session.get.call_args_list)
+    }
+    assert len(pairs) == 10
+    assert ("2024-06-13", "2024-06-20") in pairs
+    assert ("2024-06-17", "2024-06-26") in pairs
+
+@pytest.mark.asyncio
+async def test_search_for_date_survives_leader_cancellation(aviasales_service, params):
+    """Тест: отмена запроса, начавшего вызов API, не отменяет ожидающих - они повторяют запрос сами"""
+    session = make_session({"success": True, "data": [dict(t) for t in TICKETS]}, delay=0.05)
+
+    leader = asyncio.create_task(aviasales_service._search_tickets_for_date(session, params))
+    await asyncio.sleep(0.01)
+    waiter = asyncio.create_task(aviasales_service._search_tickets_for_date(session, params))
+    await asyncio.sleep(0.01)
+    leader.cancel()
+
+    result = await waiter
+
+    assert leader.cancelled()
+    assert result['success']
+    assert session.get.call_count == 2
+    assert not aviasales_service._inflight
+
+@pytest.mark.asyncio
+async def test_search_for_date_releases_semaphore_during_backoff(aviasales_service, params):
+    """Тест: пауза перед повтором не занимает слот семафора API"""
+    aviasales_service._api_semaphore = asyncio.Semaphore(1)
+    session = make_session(
+        {"success": True, "data": [dict(t) for t in TICKETS]},
+        responses=[make_response({"error": "rate limit"}, status=429, headers={"Retry-After": "0.05"})]
+    )
+
+    task = asyncio.create_task(aviasales_service._search_tickets_for_date(session, params))
+    await asyncio.sleep(0.02)
+    assert not aviasales_service._api_semaphore.locked()
+
+    result = await task
+    assert result['success']
+
+@pytest.mark.asyncio
+async def test_search_for_date_deadline(aviasales_service, params):
+    """Тест: запрос на дату прерывается по общему сроку"""
+    aviasales_service.DATE_SEARCH_DEADLINE = 0.01
+    session = make_session({"success": True, "data": [dict(t) for t in TICKETS]}, delay=1)
+
+    result = await aviasales_service._search_tickets_for_date(session, params)
+
+    assert not result['success']
+    assert not aviasales_service._inflight
+
+def test_validate_params_rejects_non_calendar_dates(aviasales_service, params):
+    """Тест: компактная и недельная формы ISO 8601 не проходят валидацию"""
+    assert aviasales_service._validate_params(params)
+    assert not aviasales_service._validate_params({**params, "departure_at": "20240615"})
+    assert not aviasales_service._validate_params({**params, "departure_at": "2024-W24-6"})
+
+@pytest.mark.asyncio
+async def test_soft_timeout_gather_cancels_requests_with_caller(aviasales_service):
+    """Тест: отмена вызывающего отменяет незавершенные запросы по датам"""
+    started = asyncio.Event()
+
+    async def request():
+        started.set()
+        await asyncio.sleep(10)
+
+    gather = asyncio.create_task(aviasales_service._gather_with_soft_timeout([request(), request()]))
+    await started.wait()
+    gather.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await gather
+    await asyncio.sleep(0)
+
+    assert all(task.done() for task in asyncio.all_tasks() if task is not asyncio.current_task())
@@ -0,0 +1,108 @@
+import asyncio
+import pytest
+from src.services.dialog_state import DialogState, DialogStateManager
+
+def test_get_state_creates_and_reuses_state():
+    """Тест: состояние создается один раз на пользователя"""
+    manager = DialogStateManager()
+
+    state = manager.get_state(1)
+
+    assert isinstance(state, DialogState)
+    assert manager.get_state(1) is state
+
+def test_idle_states_are_evicted():
+    """Тест: при переполнении вытесняется давно неактивный диалог"""
+    manager = DialogStateManager(max_states=2)
+    manager.get_state(1)
+    manager.get_state(2)
+    manager.get_state(1)  # пользователь 1 снова активен
+
+    manager.get_state(3)
+
+    assert set(manager.states) == {1, 3}
+
+def test_clear_missing_state():
+    """Тест: очистка отсутствующего состояния не приводит к ошибке"""
+    manager = DialogStateManager()
+
+    manager.clear_state(42)
+
+    assert not manager.states
+
+def test_dates_parsed_on_update():
+    """Тест: даты разбираются при обновлении, некорректная дата вылета считается незаполненной"""
+    state = DialogState(1)
+    state.update_from_params({
+        "origin": "MOW", "destination": "PAR",
+        "origin_city": "Москва", "destination_city": "Париж",
+        "departure_at": "2024-06-15", "return_at": "2024-06-22",
+    })
+
+    assert state.is_complete
+    assert state.return_days == 7
+
+    state.update_from_params({"departure_at": "2024-06"})
+
+    assert not state.is_complete
+    assert state.get_missing_params() == ["дату вылета"]
+
+def test_search_params_memoized_until_update():
+    """Тест: параметры поиска пересчитываются только после обновления состояния"""
+    state = DialogState(1)
+    state.update_from_params({"origin": "MOW", "destination": "PAR", "departure_at": "2024-06-15"})
+
+    params = state.to_search_params()
+    assert state.to_search_params() is params
+
+    state.update_from_params({"return_at": "2024-06-22"})
+
+    assert state.to_search_params()["return_at"] == "2024-06-22"
+
+@pytest.mark.asyncio
+async def test_with_state_serializes_same_user():
+    """Тест: сообщения одного пользователя обрабатываются по очереди, другие пользователи не ждут"""
+    manager = DialogStateManager()
+    events = []
+
+    async def handle(user_id, name):
+        async with manager.with_state(user_id) as state:
+            events.append(f"{name}:start")
+            await asyncio.sleep(0.01)
+            state.origin = name
+            events.append(f"{name}:end")
+
+    await asyncio.gather(handle(1, "a"), handle(1, "b"), handle(2, "c"))
+
+    assert events.index("a:end") < events.index("b:start")
+    assert events.index("c:start") < events.index("a:end")
+
+@pytest.mark.asyncio
+async def test_with_state_keeps_lock_with_waiters():
+    """Тест: блокировка, которую ждет разбуженный, но еще не захвативший ее обработчик, не вытесняется"""
+    manager = DialogStateManager(max_states=1)
+    order = []
+
+    async def handle(user_id, name, delay, after=None):
+        async with manager.with_state(user_id):
+            order.append(f"{name}:start")
+            await asyncio.sleep(delay)
+            order.append(f"{name}:end")
+        if after:
+            after()  # выполняется сразу после освобождения, до того как ожидающий захватит блокировку
+
+    first = asyncio.create_task(handle(1, "a", 0.01, after=lambda: manager._get_lock(2)))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(handle(1, "b", 0.02))
+    await first
+    third = asyncio.create_task(handle(1, "c", 0))
+    await asyncio.gather(second, third)
+
+    assert order.index("b:end") < order.index("c:start")
+    assert not manager._lock_users
+
+def test_dates_require_iso_calendar_format():
+    """Тест: принимаются только даты вида YYYY-MM-DD"""
+    assert DialogState._parse_date("2025-01-01") is not None
+    assert DialogState._parse_date("20250101") is None
+    assert DialogState._parse_date("2025-W01-1") is None
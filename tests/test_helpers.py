@@ -0,0 +1,51 @@
+from src.utils.helpers import format_date, format_ticket_message, format_transfers, NOT_FOUND_MESSAGE
+
+TICKET = {
+    "price": 15000,
+    "link": "/search/MOW1506PAR1",
+    "departure_at": "2024-06-15T10:30:00+03:00",
+    "return_at": "2024-06-22T18:00:00+02:00",
+    "duration_to": 270,
+    "duration_back": 255,
+    "transfers": 0,
+    "return_transfers": 2,
+}
+
+def test_format_ticket_message():
+    """Тест форматирования билета туда и обратно"""
+    message = format_ticket_message([TICKET])
+
+    assert "🎫 Вариант 1:" in message
+    assert "<a href='https://www.aviasales.ru/search/MOW1506PAR1'>15 000₽</a> RUB" in message
+    assert "✈️ Туда: 15.06.2024 10:30" in message
+    assert "⭐️ Прямой рейс (4ч 30мин)" in message
+    assert "🔄 Обратно: 22.06.2024 18:00" in message
+    assert "🛑 2 пересадки (4ч 15мин)" in message
+
+def test_format_ticket_message_unknown_return_transfers():
+    """Тест: неизвестные пересадки обратного рейса не выдаются за прямой рейс"""
+    ticket = {key: value for key, value in TICKET.items() if key != "return_transfers"}
+
+    message = format_ticket_message([ticket])
+
+    assert "🔄 Обратно: 22.06.2024 18:00\n⏱ 4ч 15мин" in message
+    assert message.count("Прямой рейс") == 1
+
+def test_format_ticket_message_empty():
+    """Тест пустого списка билетов"""
+    assert format_ticket_message([]) == NOT_FOUND_MESSAGE
+    assert format_ticket_message({"success": False}) == NOT_FOUND_MESSAGE
+
+def test_format_transfers():
+    """Тест склонения количества пересадок"""
+    assert format_transfers(0) == "Прямой рейс"
+    assert format_transfers(1) == "1 пересадка"
+    assert format_transfers(3) == "3 пересадки"
+    assert format_transfers(5) == "5 пересадок"
+
+def test_format_date():
+    """Тест форматирования даты: время остается в часовом поясе из API"""
+    assert format_date("2024-06-15T10:30:00+03:00") == "15.06.2024 10:30"
+    assert format_date("2024-06-22T18:05:00Z") == "22.06.2024 18:05"
+    assert format_date("2024-06-15") == "15.06.2024 00:00"
+    assert format_date("завтра") == "завтра"
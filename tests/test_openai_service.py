@@ -1,3 +1,5 @@
+import asyncio
+import json
 import pytest
 from unittest.mock import AsyncMock, patch, MagicMock
 from datetime import datetime
@@ -16,7 +18,8 @@ def openai_service():
 async def test_extract_flight_params_success(openai_service):
     """Тест успешного извлечения параметров полета"""
     # Подготовка тестовых данных
-    test_text = "Найди билеты из Москвы в Париж на 15 июня"
+    # Месяц без конкретного дня локально не разбирается и уходит в OpenAI
+    test_text = "Найди билеты из Москвы в Париж в июне"
     mock_response = MagicMock()
     mock_response.choices = [
         MagicMock(
@@ -49,7 +52,7 @@ async def test_extract_flight_params_success(openai_service):
 @pytest.mark.asyncio
 async def test_extract_flight_params_with_return(openai_service):
     """Тест извлечения параметров для полета туда и обратно"""
-    test_text = "Москва-Париж 15 июня на неделю"
+    test_text = "Москва-Париж 15 июня и обратно через неделю"
     mock_response = MagicMock()
     mock_response.choices = [
         MagicMock(
@@ -122,6 +125,9 @@ async def test_extract_flight_params_with_current_state(openai_service):
     assert result["departure_at"] == "2024-06-22"
     assert result["origin"] == current_state["origin"]
     assert result["destination"] == current_state["destination"]
+    # Состояние диалога передается модели
+    system_prompt = openai_service.client.chat.completions.create.call_args.kwargs["messages"][0]["content"]
+    assert '"origin":"MOW"' in system_prompt
 
 @pytest.mark.asyncio
 async def test_extract_flight_params_api_error(openai_service):
@@ -133,3 +139,228 @@ async def test_extract_flight_params_api_error(openai_service):
     
     result = await openai_service.extract_flight_params(test_text)
     assert result == {}
+
+@pytest.mark.asyncio
+async def test_extract_flight_params_cached(openai_service):
+    """Тест повторного запроса: ответ берется из кэша без вызова OpenAI"""
+    mock_response = MagicMock()
+    mock_response.choices = [
+        MagicMock(
+            message=MagicMock(
+                content='''{
+                    "origin": "MOW",
+                    "destination": "PAR",
+                    "origin_city": "Москва",
+                    "destination_city": "Париж",
+                    "departure_at": "2024-06-15"
+                }'''
+            )
+        )
+    ]
+    openai_service.client.chat.completions.create.return_value = mock_response
+
+    first = await openai_service.extract_flight_params("Москва-Париж в июне")
+    second = await openai_service.extract_flight_params("  москва-париж в июне!")
+
+    assert first == second
+    assert openai_service.client.chat.completions.create.call_count == 1
+
+    # Другое состояние диалога - другой ключ кэша
+    await openai_service.extract_flight_params("Москва-Париж в июне", {"origin": "LED"})
+    assert openai_service.client.chat.completions.create.call_count == 2
+
+@pytest.mark.asyncio
+async def test_extract_flight_params_error_not_cached(openai_service):
+    """Тест: пустой результат при ошибке не кэшируется"""
+    openai_service.client.chat.completions.create.side_effect = Exception("API Error")
+
+    assert await openai_service.extract_flight_params("Москва-Париж завтра") == {}
+    assert await openai_service.extract_flight_params("Москва-Париж завтра") == {}
+    assert openai_service.client.chat.completions.create.call_count == 2
+
+@pytest.mark.asyncio
+async def test_extract_flight_params_local(openai_service):
+    """Тест: простой запрос разбирается локально без вызова OpenAI"""
+    result = await openai_service.extract_flight_params("Найди билеты из Питера в Барселону на 15.06")
+
+    assert result["origin"] == "LED"
+    assert result["destination"] == "BCN"
+    assert result["origin_city"] == "Санкт-Петербург"
+    assert result["destination_city"] == "Барселона"
+    assert datetime.strptime(result["departure_at"], "%Y-%m-%d").date() >= datetime.now().date()
+    assert result["departure_at"].endswith("-06-15")
+    openai_service.client.chat.completions.create.assert_not_called()
+
+def test_try_local_extract_falls_back(openai_service):
+    """Тест: неоднозначные запросы локально не разбираются"""
+    today = datetime(2024, 5, 1).date()
+
+    assert openai_service._try_local_extract("из Москвы в Париж 15 июня", today)["departure_at"] == "2024-06-15"
+    assert openai_service._try_local_extract("из Москвы в Париж 15 апреля", today)["departure_at"] == "2025-04-15"
+    # Нет даты, неизвестный город, обратный билет
+    assert openai_service._try_local_extract("из Москвы в Париж", today) == {}
+    assert openai_service._try_local_extract("из Москвы в Урюпинск 15 июня", today) == {}
+    assert openai_service._try_local_extract("из Москвы в Париж 15 июня и обратно 20 июня", today) == {}
+
+def test_try_local_extract_city_pair(openai_service):
+    """Тест: пара городов через дефис или IATA коды разбираются локально"""
+    today = datetime(2024, 5, 1).date()
+
+    result = openai_service._try_local_extract("Питер - Стамбул 2024-06-15", today)
+    assert (result["origin"], result["destination"], result["departure_at"]) == ("LED", "IST", "2024-06-15")
+    result = openai_service._try_local_extract("MOW-PAR 15.06", today)
+    assert (result["origin_city"], result["destination_city"]) == ("Москва", "Париж")
+    assert openai_service._try_local_extract("санкт-петербург-москва 15 июня", today)["origin"] == "LED"
+    # Неизвестный код и пара без даты уходят в модель
+    assert openai_service._try_local_extract("MOW-XXX 15.06", today) == {}
+    assert openai_service._try_local_extract("Москва-Париж в июне", today) == {}
+
+def test_try_local_extract_start_of_month_and_duration(openai_service):
+    """Тест: начало месяца и длительность поездки разбираются локально так же, как после ответа модели"""
+    today = datetime(2024, 5, 1).date()
+
+    result = openai_service._try_local_extract("Из Питера в Бангкок в начале февраля на 15-20 дней", today)
+    assert result["departure_at"] == "2025-02-01"
+    assert result["return_at"] == "2025-02-21"
+    assert result["flexible_dates"]
+    assert result["date_context"] == {"is_start_of_month": True, "month_number": 2, "duration_days": [15, 20]}
+
+    result = openai_service._try_local_extract("из Москвы в Париж 15 июня на неделю", today)
+    assert result["return_at"] == "2024-06-22"
+    assert result["date_context"] == {"duration_days": 7}
+    # Начало месяца вместе с конкретной датой неоднозначно
+    assert openai_service._try_local_extract("из Москвы в Париж в начале июня 15.06", today) == {}
+
+@pytest.mark.asyncio
+async def test_rank_tickets_uses_local_ranker(openai_service):
+    """Тест: без USE_LLM_RANKING билеты ранжируются локально, без запроса к OpenAI"""
+    ranked = {"ranked_tickets": [], "summary": "Нет билетов для ранжирования"}
+    openai_service.local_ranker = MagicMock()
+    openai_service.local_ranker.rank_tickets.return_value = ranked
+
+    result = await openai_service.rank_tickets([])
+
+    assert result is ranked
+    openai_service.client.chat.completions.create.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_rank_tickets_restores_tickets_from_order(openai_service):
+    """Тест: модель возвращает только индексы, билеты восстанавливаются из исходного списка"""
+    tickets = [{"price": 3, "link": "/c"}, {"price": 1, "link": "/a"}, {"price": 2, "link": "/b"}]
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock(message=MagicMock(content='{"order": [true, 2, 1, 1, 7], "summary": "ok"}'))]
+    openai_service.client.chat.completions.create.return_value = mock_response
+
+    with patch('src.services.openai_service.Config.USE_LLM_RANKING', True):
+        result = await openai_service.rank_tickets(tickets)
+
+    assert [ticket["link"] for ticket in result["ranked_tickets"]] == ["/b", "/a", "/c"]
+    assert result["ranked_tickets"][0] is tickets[2]
+    call_kwargs = openai_service.client.chat.completions.create.call_args.kwargs
+    assert call_kwargs["temperature"] == 0
+    # В модель уходят только поля, влияющие на порядок
+    assert json.loads(call_kwargs["messages"][1]["content"]) == [{"price": 3}, {"price": 1}, {"price": 2}]
+
+@pytest.mark.asyncio
+async def test_completion_requests_are_bounded(openai_service):
+    """Тест: одновременных запросов к OpenAI не больше MAX_CONCURRENT_REQUESTS"""
+    active = peak = 0
+
+    async def create(**kwargs):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+
+    openai_service.client.chat.completions.create = create
+    openai_service._api_semaphore = asyncio.Semaphore(2)
+
+    await asyncio.gather(*[openai_service._create_completion(model="m") for _ in range(5)])
+
+    assert peak == 2
+
+@pytest.mark.asyncio
+async def test_extract_flight_params_coalesces_concurrent_requests(openai_service):
+    """Тест: одновременные одинаковые запросы выполняются одним вызовом модели"""
+    content = '{"origin": "MOW", "destination": "PAR", "origin_city": "Москва", "destination_city": "Париж", "departure_at": "2024-06-15"}'
+
+    async def create(**kwargs):
+        await asyncio.sleep(0.01)
+        return MagicMock(choices=[MagicMock(message=MagicMock(content=content))])
+
+    openai_service.client.chat.completions.create = AsyncMock(side_effect=create)
+
+    results = await asyncio.gather(*[
+        openai_service.extract_flight_params("Москва-Париж в июне") for _ in range(3)
+    ])
+
+    assert openai_service.client.chat.completions.create.call_count == 1
+    assert all(result["destination"] == "PAR" for result in results)
+    assert results[0] is not results[1]
+    assert not openai_service._params_inflight
+
+@pytest.mark.asyncio
+async def test_extract_flight_params_negative_cache(openai_service):
+    """Тест: непригодный ответ модели кэшируется на короткое время, ошибки API - нет"""
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock(message=MagicMock(content='{"origin": "MOW"}'))]
+    openai_service.client.chat.completions.create.return_value = mock_response
+
+    assert await openai_service.extract_flight_params("хочу куда-нибудь") == {}
+    assert await openai_service.extract_flight_params("Хочу  куда-нибудь!") == {}
+    assert openai_service.client.chat.completions.create.call_count == 1
+
+@pytest.mark.asyncio
+async def test_extract_flight_params_drops_null_fields(openai_service):
+    """Тест: null-поля ответа по схеме не попадают в параметры и не затирают состояние диалога"""
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock(message=MagicMock(content='''{
+        "origin": "MOW", "destination": "PAR", "origin_city": "Москва", "destination_city": "Париж",
+        "departure_at": "2024-06-15", "return_at": null, "flexible_dates": false,
+        "date_context": {"is_start_of_month": null, "is_mid_month": null, "is_end_month": null,
+                         "month_number": null, "relative_days": null, "season": null, "duration_days": 7}
+    }'''))]
+    openai_service.client.chat.completions.create.return_value = mock_response
+
+    result = await openai_service.extract_flight_params("Москва-Париж в июне")
+
+    assert "return_at" not in result
+    assert result["date_context"] == {"duration_days": 7}
+    response_format = openai_service.client.chat.completions.create.call_args.kwargs["response_format"]
+    assert response_format["type"] == "json_schema"
+
+@pytest.mark.asyncio
+async def test_extract_flight_params_uses_extract_model_and_client(openai_service):
+    """Тест: извлечение идет в отдельную модель и на отдельный сервер, если он задан"""
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock(message=MagicMock(
+        content='{"origin": "MOW", "destination": "PAR", "origin_city": "Москва", '
+                '"destination_city": "Париж", "departure_at": "2024-06-15"}'
+    ))]
+    openai_service.extract_client = MagicMock()
+    openai_service.extract_client.chat.completions.create = AsyncMock(return_value=mock_response)
+    openai_service.extract_model = "local-extractor"
+
+    result = await openai_service.extract_flight_params("Москва-Париж в июне")
+
+    assert result["origin"] == "MOW"
+    openai_service.client.chat.completions.create.assert_not_called()
+    call_kwargs = openai_service.extract_client.chat.completions.create.call_args.kwargs
+    assert call_kwargs["model"] == "local-extractor"
+
+@pytest.mark.asyncio
+async def test_openai_client_is_shared_and_closed():
+    """Тест: клиент OpenAI общий для экземпляров сервиса и пересоздается после закрытия"""
+    from src.services import openai_service as module
+
+    with patch.dict(module._clients, clear=True), patch.object(module, 'AsyncOpenAI') as mock_openai:
+        mock_openai.side_effect = lambda **kwargs: MagicMock(close=AsyncMock())
+        first = OpenAIService()
+        second = OpenAIService()
+        assert first.client is second.client
+
+        client = first.client
+        await first.close()
+        client.close.assert_awaited_once()
+        assert OpenAIService().client is not client